@@ -1,6 +1,7 @@
 import asyncio
 import json
 import logging
+import time
 from app import app
 
 def test_queries():
@@ -33,6 +34,618 @@ def test_queries():
         
         return response.json
 
+def reference_npmimatrix(results):
+    """The original dense, loop-based NPMI computation, kept to check get_npmimatrix against"""
+    from itertools import combinations
+    import numpy as np
+    from app._topicmod import get_topics_set, topic_idx_association
+
+    topics = get_topics_set(results)
+    idx_t = topic_idx_association(topics)
+    mutualmatrix = np.zeros([len(topics), len(topics)])
+    for _, res in results.iterrows():
+        for t in res["topics"]:
+            id = idx_t[t["id"]]
+            mutualmatrix[id, id] = mutualmatrix[id, id] + 1
+        for ti, tj in combinations(res["topics"], r=2):
+            idi, idj = idx_t[ti["id"]], idx_t[tj["id"]]
+            mutualmatrix[idi, idj] = mutualmatrix[idi, idj] + 1
+            mutualmatrix[idj, idi] = mutualmatrix[idj, idi] + 1
+    probmatrix = mutualmatrix / len(mutualmatrix)
+    npmimatrix = np.zeros_like(probmatrix)
+    for i, j in combinations(range(probmatrix.shape[0]), r=2):
+        if probmatrix[i, j] > 0:
+            npmimatrix[i, j] = np.log2(probmatrix[i, j]/(probmatrix[i, i]*probmatrix[j, j]))/(-np.log2(probmatrix[i, j]))
+            npmimatrix[j, i] = npmimatrix[i, j]
+    return npmimatrix, idx_t
+
+def random_results(n_works=2000, n_topics=1200, seed=0):
+    """Candidate works with 1-3 random OpenAlex-style topics each"""
+    import random
+    import pandas as pd
+
+    rng = random.Random(seed)
+    return pd.DataFrame({
+        "doi": [f"https://doi.org/10.1000/{i}" for i in range(n_works)],
+        "topics": [
+            [{"id": f"https://openalex.org/T{t}"} for t in rng.sample(range(n_topics), rng.randint(1, 3))]
+            for _ in range(n_works)
+        ],
+    })
+
+def clustered_results(n_works=3000, n_fields=20, topics_per_field=20, seed=0):
+    """Candidate works whose 3 topics mostly come from one field, skewed towards a few popular topics"""
+    import random
+    import pandas as pd
+
+    rng = random.Random(seed)
+    works = []
+    for i in range(n_works):
+        field, topics = rng.randrange(n_fields), set()
+        while len(topics) < 3:
+            topic_field = field if rng.random() < 0.85 else rng.randrange(n_fields)
+            topics.add(topic_field * topics_per_field + int(rng.paretovariate(1.2)) % topics_per_field)
+        works.append({
+            "doi": f"https://doi.org/10.1000/{i}",
+            "topics": [{"id": f"https://openalex.org/T{t}"} for t in topics],
+        })
+    return pd.DataFrame(works)
+
+def test_npmimatrix():
+    import numpy as np
+    from app._topicmod import get_npmimatrix
+
+    for results in [random_results(), random_results(n_works=300, n_topics=40, seed=1)]:
+        npmimatrix, idx_t = get_npmimatrix(results, return_idx=True)
+        expected, expected_idx_t = reference_npmimatrix(results)
+        assert idx_t.keys() == expected_idx_t.keys()
+        # Topic indices may be assigned in a different order
+        order = [idx_t[topic] for topic in expected_idx_t]
+        np.testing.assert_allclose(npmimatrix.toarray()[np.ix_(order, order)], expected, rtol=1e-12, atol=1e-12)
+    print("get_npmimatrix matches the reference implementation")
+
+def reference_rank_results(results, top_k=20, exclude_dois=None):
+    """The original iterrows-based rank_results, kept to check the vectorized one against"""
+    from itertools import combinations
+    from app._topicmod import get_npmimatrix
+
+    results = results.copy()
+    npmimatrix, idx_t = get_npmimatrix(results, return_idx=True)
+    results["score"] = 0.0
+    for i, work in results.iterrows():
+        for ti, tj in combinations(work["topics"], r=2):
+            results.loc[i, "score"] += npmimatrix[idx_t[ti["id"]], idx_t[tj["id"]]]
+    results = results.drop_duplicates(subset=['doi'])
+    if exclude_dois:
+        results = results[~results['doi'].isin(exclude_dois)]
+    results = results.sort_values(by="score", ascending=True, kind="stable")
+    return results[:top_k]
+
+def test_rank_results():
+    import numpy as np
+    import pandas as pd
+    from app._openalex import with_topic_ids
+    from app._topicmod import rank_results
+
+    base = random_results(n_works=1500, n_topics=300, seed=2)
+    # Duplicated DOIs and excluded inputs are part of every real candidate set
+    results = pd.concat([base, base.sample(200, random_state=0)], ignore_index=True)
+    exclude = list(base["doi"][:50])
+    # What the fetchers hand over: interned topic_ids instead of the topic dicts
+    encoded = pd.DataFrame([with_topic_ids(paper) for paper in results.to_dict("records")])
+    for top_k in [1, 20, 100, 5000]:
+        expected = reference_rank_results(results, top_k=top_k, exclude_dois=exclude)
+        for candidates in [results, encoded]:
+            ranked = rank_results(candidates, top_k=top_k, exclude_dois=exclude)
+            assert list(ranked["doi"]) == list(expected["doi"])
+            np.testing.assert_allclose(ranked["score"], expected["score"], rtol=1e-9, atol=1e-12)
+    # Clients send bare DOIs, OpenAlex answers with doi.org URLs
+    bare = [doi.removeprefix("https://doi.org/").upper() for doi in exclude]
+    ranked = rank_results(results, top_k=5000, exclude_dois=bare)
+    assert list(ranked["doi"]) == list(reference_rank_results(results, top_k=5000, exclude_dois=exclude)["doi"])
+    print("rank_results matches the reference implementation")
+
+def test_npmi_prior():
+    from collections import Counter
+    from itertools import combinations
+    import numpy as np
+    from app._npmi_prior import build_npmi_prior
+    from app._topicmod import rank_results, topic_vocabulary
+
+    results = random_results(n_works=3000, n_topics=100, seed=3)
+    prior = build_npmi_prior(results.to_dict("records"), min_count=1, chunk_size=700)
+    # Brute force: standard NPMI over the works, probabilities normalized by the number of works
+    singles, pairs = Counter(), Counter()
+    for topics in results["topics"]:
+        ids = sorted({t["id"] for t in topics})
+        singles.update(ids)
+        pairs.update(combinations(ids, 2))
+    n = len(results)
+    (x, y), c = pairs.most_common(1)[0]
+    expected = np.log2((c / n) / (singles[x] / n * singles[y] / n)) / -np.log2(c / n)
+    a, b = topic_vocabulary.intern(x), topic_vocabulary.intern(y)
+    assert len(prior) == len(pairs)
+    np.testing.assert_allclose(prior.lookup(np.array([a, b]), np.array([b, a])), [expected, expected], rtol=1e-6)
+    assert prior.lookup(np.array([a]), np.array([a]))[0] == 0
+
+    request = rank_results(results, top_k=50)
+    for source in ["prior", "blend"]:
+        ranked = rank_results(results, top_k=50, npmi_source=source, prior=prior)
+        assert len(ranked) == 50 and ranked["score"].is_monotonic_increasing
+    blended = rank_results(results, top_k=50, npmi_source="blend", prior=prior, prior_weight=0)
+    assert list(blended["doi"]) == list(request["doi"])
+    print("NPMI prior matches a brute force count")
+
+def test_incremental_ranker():
+    import numpy as np
+    import pandas as pd
+    from app._topicmod import IncrementalRanker, rank_results
+
+    base = random_results(n_works=3000, n_topics=400, seed=4)
+    results = pd.concat([base, base.sample(300, random_state=1)], ignore_index=True)
+    exclude = list(base["doi"][:50])
+    papers = results.to_dict("records")
+    expected = rank_results(results, top_k=100, exclude_dois=exclude)
+    # With room for every candidate, the final rescore is exact whatever the page size
+    bare = [doi.removeprefix("https://doi.org/") for doi in exclude]
+    ranker = IncrementalRanker(top_k=100, exclude_dois=bare, oversample=len(papers))
+    for i in range(0, len(papers), 200):
+        ranker.add(papers[i:i + 200])
+    ranked = ranker.result()
+    assert list(ranked["doi"]) == list(expected["doi"])
+    np.testing.assert_allclose(ranked["score"], expected["score"])
+    # A bounded pool only approximates it, closely when topics cluster by field as real ones do
+    results = clustered_results()
+    papers = results.to_dict("records")
+    expected = rank_results(results, top_k=100)
+    ranker = IncrementalRanker(top_k=100)
+    for i in range(0, len(papers), 200):
+        ranker.add(papers[i:i + 200])
+    overlap = len(set(ranker.result()["doi"]) & set(expected["doi"]))
+    assert overlap >= 90
+    print(f"IncrementalRanker matches rank_results, {overlap}/100 shared with a bounded pool")
+
+def benchmark_pagerank(n_works=30000, n_citations=100000, runs=5):
+    """Personalized PageRank on a random citation graph the size of a large colab crawl"""
+    import numpy as np
+    from app._pagerank import CitationGraph, personalized_pagerank
+
+    rng = np.random.default_rng(0)
+    graph = CitationGraph()
+    graph.add_edges(
+        (f"W{citing}", f"W{cited}")
+        for citing, cited in rng.integers(0, n_works, size=(n_citations, 2))
+    )
+    for seed in range(5):
+        graph.add_seed(f"W{seed}")
+    start = time.time()
+    adjacency = graph.adjacency()
+    build = time.time() - start
+    seeds = [graph.index[seed] for seed in graph.seeds]
+    start = time.time()
+    for _ in range(runs):
+        ranks = personalized_pagerank(adjacency, seeds)
+    elapsed = (time.time() - start) / runs
+    assert abs(ranks.sum() - 1) < 1e-6
+    print(f"PageRank over {len(graph.index)} works / {len(graph)} citations: "
+          f"adjacency {build * 1000:.0f}ms, power iteration {elapsed * 1000:.0f}ms")
+    assert build + elapsed < 1.0
+
+def inverted_index(text):
+    index = {}
+    for position, word in enumerate(text.split()):
+        index.setdefault(word, []).append(position)
+    return index
+
+def test_lexical_index():
+    import math
+    import random
+    import numpy as np
+    from app._lexical import LexicalIndex
+
+    rng = random.Random(5)
+    words = [f"term{i}" for i in range(300)]
+    abstracts = [" ".join(rng.choices(words[:rng.randint(20, 300)], k=rng.randint(5, 80))) for _ in range(400)]
+    seeds = abstracts[:3]
+    index = LexicalIndex()
+    scores = index.similarity(
+        [inverted_index(a) for a in abstracts], [f"W{i}" for i in range(len(abstracts))],
+        [inverted_index(a) for a in seeds], [f"W{i}" for i in range(3)],
+    )
+    # Brute force BM25, each seed's distinct terms taken as a query
+    documents = [a.split() for a in abstracts]
+    average = sum(map(len, documents)) / len(documents)
+    df = {w: sum(w in set(d) for d in documents) for w in words}
+    def bm25(query, document):
+        total = 0.0
+        for w in set(query):
+            tf = document.count(w)
+            idf = math.log1p((len(documents) - df[w] + 0.5) / (df[w] + 0.5))
+            total += idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * len(document) / average))
+        return total
+    expected = [np.mean([bm25(seed.split(), d) for seed in seeds]) for d in documents]
+    np.testing.assert_allclose(scores, expected, rtol=1e-9)
+    # Works already counted don't move the statistics
+    index.similarity([inverted_index(abstracts[0])], ["W0"], [], [])
+    assert index.documents == len(abstracts)
+    print("LexicalIndex matches a brute force BM25")
+
+def test_lexical_index_bounded():
+    import random
+    import numpy as np
+    from app._lexical import LexicalIndex
+
+    rng = random.Random(6)
+    index = LexicalIndex(buckets=2**12, max_documents=1000, max_words=500)
+    seeds = [inverted_index("graph neural networks for molecules")]
+    sizes = set()
+    for batch in range(30):
+        # Every batch brings new works and new words, like a long-lived server does
+        abstracts = [
+            inverted_index(" ".join(f"w{batch}x{rng.randrange(400)}" for _ in range(40))) for _ in range(200)
+        ]
+        ids = [f"W{batch * 1000 + i}" for i in range(200)]
+        scores = index.similarity(abstracts, ids, seeds, ["W999999"])
+        assert np.isfinite(scores).all()
+        sizes.add(index.document_frequency.nbytes)
+        assert len(index._seen) <= index.max_documents and len(index._words) <= index.max_words
+        assert index.documents <= index.max_documents
+    assert len(sizes) == 1  # the term statistics never grow
+    # Words without a token ("a", dashes) are memoized too, not tokenized again for every abstract
+    small = LexicalIndex(buckets=2**8, max_words=10)
+    document = {"a": [0], "—": [1], "graph": [2]}
+    small.term_counts([document])
+    words, small._word_terms = small._words, None
+    _, lengths = small.term_counts([document])
+    assert small._words is words and words["a"] == () and list(lengths) == [1]
+    print(f"LexicalIndex stays bounded over 6000 works, {index.stats()}")
+
+def test_pooled_rankings():
+    import random
+    import pandas as pd
+    import app._executor as executor
+    from app._lexical import LexicalIndex, rank_by_lexical
+    from app._pagerank import CitationGraph, rank_by_pagerank
+
+    rng = random.Random(7)
+    words = [f"term{i}" for i in range(200)]
+    results = pd.DataFrame([
+        {"id": f"https://openalex.org/W{i}", "doi": f"https://doi.org/10.1000/w{i}",
+         "abstract_inverted_index": inverted_index(" ".join(rng.choices(words, k=40)))}
+        for i in range(300)
+    ])
+    seeds = results.iloc[:3]
+    graph = CitationGraph()
+    graph.add_edges((f"W{rng.randrange(300)}", f"W{rng.randrange(300)}") for _ in range(1500))
+    for seed in range(3):
+        graph.add_seed(f"W{seed}")
+    exclude = ["10.1000/W10"]
+
+    async def pooled():
+        lexical = await executor.rank_by_lexical_async(results, seeds, top_k=20, exclude_dois=exclude,
+                                                       index=LexicalIndex())
+        pagerank = await executor.rank_by_pagerank_async(results, graph, top_k=20, exclude_dois=exclude)
+        return lexical, pagerank
+
+    shared = executor.ranking_executor
+    executor.ranking_executor = executor.RankingExecutor(workers=1, inline_threshold=0)
+    try:
+        lexical, pagerank = asyncio.run(pooled())
+        assert executor.ranking_executor._pool is not None  # the scores did come from the pool
+    finally:
+        executor.ranking_executor.shutdown()
+        executor.ranking_executor = shared
+    pd.testing.assert_frame_equal(
+        lexical, rank_by_lexical(results, seeds, top_k=20, exclude_dois=exclude, index=LexicalIndex())
+    )
+    pd.testing.assert_frame_equal(pagerank, rank_by_pagerank(results, graph, top_k=20, exclude_dois=exclude))
+    assert "https://doi.org/10.1000/w10" not in set(lexical["doi"]) | set(pagerank["doi"])
+    print("BM25 and PageRank rankings match when computed in the process pool")
+
+def test_reconstruct_abstract():
+    import random
+    from app._openalex import AbstractCache, abstract_cache, reconstruct_abstract, reconstruct_abstracts
+
+    rng = random.Random(6)
+    words = [f"word{i}" for i in range(500)]
+    text = " ".join(rng.choices(words, k=250))
+    index = inverted_index(text)
+    assert reconstruct_abstract(index) == text
+    assert reconstruct_abstract(None) == "MISSING_ABSTRACT"
+    # Memoized by work ID, in either spelling
+    assert reconstruct_abstract(index, "https://openalex.org/W1") == text
+    assert reconstruct_abstract({}, "W1") == text
+    assert reconstruct_abstracts([None, index], ["W1", None]) == [text, text]
+    cache = AbstractCache(2)
+    for work_id in ("W1", "W2", "W1", "W3"):
+        cache.put(work_id, work_id)
+    assert cache.get("W2") is None and cache.get("W1") == "W1" and len(cache) == 2
+
+    indexes = [inverted_index(" ".join(rng.choices(words, k=200))) for _ in range(2000)]
+    start = time.perf_counter()
+    reconstruct_abstracts(indexes)
+    print(f"Rebuilt {len(indexes)} abstracts in {time.perf_counter() - start:.3f}s, {len(abstract_cache)} cached")
+
+def test_work_deduper():
+    import pandas as pd
+    from app._dedup import WorkDeduper, doi_mask, first_occurrences
+
+    papers = [
+        {"id": "https://openalex.org/W1", "doi": "https://doi.org/10.1000/A"},
+        {"id": "W1", "doi": None},  # same ID, other spelling
+        {"id": "https://openalex.org/W2", "doi": "10.1000/a"},  # same DOI under another ID
+        {"id": "https://openalex.org/W3", "doi": None},
+        {"id": "https://openalex.org/W4", "doi": None},  # null DOIs are not duplicates of each other
+        {"id": "https://openalex.org/W3", "doi": None},
+    ]
+    deduper = WorkDeduper()
+    assert [p["id"][-2:] for p in deduper.filter(papers)] == ["W1", "W3", "W4"]
+    assert deduper.filter(papers) == [] and "W4" in deduper and len(deduper) == 3
+    assert first_occurrences(pd.DataFrame(papers)).tolist() == [True, False, False, True, True, False]
+    assert doi_mask(pd.DataFrame(papers), ["doi:10.1000/a"]).tolist() == [True, False, True, False, False, False]
+    print("WorkDeduper keeps one row per work")
+
+def test_llm_cache():
+    import os
+    import tempfile
+    from app._cache import KeyValueCache
+    from app._openai import keyword_cache_key
+
+    cache = KeyValueCache(os.path.join(tempfile.mkdtemp(), "llm.sqlite"), ttl=60, max_entries=2)
+    cache.put("a", ["q1", "q2"])
+    cache.put("b", ["q3"])
+    assert cache.get("a") == ["q1", "q2"]
+    cache.put("c", ["q4"])  # "b" is the least recently read
+    assert cache.get("b") is None and cache.get("c") == ["q4"]
+    cache.ttl = 0
+    assert cache.get("a") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    def messages(*blocks):
+        return [{"content": "system"}, {"content": "\n------\n".join(blocks) + "\n------\n"}]
+    key = keyword_cache_key(messages("title:: A\nabstract:: x  y", "title:: B\nabstract:: z"))
+    # Same reading list, in another order and with other whitespace
+    assert key == keyword_cache_key(messages("title:: B\nabstract:: z ", "title:: A\nabstract:: x y"))
+    assert key != keyword_cache_key(messages("title:: A\nabstract:: x y"))
+    assert key != keyword_cache_key(messages("title:: A\nabstract:: x y", "title:: B\nabstract:: z"), model="other")
+    print("LLM query cache keys and eviction work")
+
+def test_local_keywords():
+    import pandas as pd
+    from app._keywords import local_keywords
+
+    papers = pd.DataFrame([
+        {"title": "Graph Neural Networks for Protein Structure Prediction",
+         "abstract": "We propose a graph neural network that predicts protein structure from sequence. "
+                     "Message passing over residue contact graphs improves folding accuracy."},
+        {"title": "Protein folding with deep learning",
+         "abstract": "Deep learning models such as AlphaFold have transformed protein folding."},
+        {"title": "Quantum chemistry with equivariant networks",
+         "abstract": "Equivariant graph networks learn molecular energies for quantum chemistry."},
+        {"title": "Untitled", "abstract": "MISSING_ABSTRACT"},
+    ])
+    start = time.perf_counter()
+    queries = local_keywords(papers)
+    elapsed = time.perf_counter() - start
+    assert len(queries) == 6 and len(set(queries)) == 6
+    assert all(3 <= len(query.split()) <= 5 for query in queries)
+    assert all(len(set(query.split())) == len(query.split()) for query in queries)
+    assert local_keywords(papers.iloc[:0]) == []
+    print(f"Extracted {queries} in {elapsed * 1000:.1f}ms")
+
+def test_keyword_fallback():
+    import pandas as pd
+    from flask import g
+    import app._keywords as keywords
+
+    papers = pd.DataFrame([{"title": "Graph neural networks for protein folding",
+                            "abstract": "Deep learning of protein structure from residue contact graphs."}])
+
+    async def trickling(papers, use_cache=True):
+        # Answers keep coming, each well within a per-read timeout, but too late as a whole
+        for query in ["first llm query", "second llm query"]:
+            await asyncio.sleep(0.15)
+            yield query
+
+    async def collect():
+        return [query async for query in keywords.keyword_queries(papers)]
+
+    stream, timeout = keywords.stream_keywords_from_abstracts, app.config["OPENAI_TIMEOUT"]
+    keywords.stream_keywords_from_abstracts = trickling
+    try:
+        app.config["OPENAI_TIMEOUT"] = 1
+        assert asyncio.run(collect()) == ["first llm query", "second llm query"]
+        app.config["OPENAI_TIMEOUT"] = 0.1
+        with app.test_request_context():
+            start = time.perf_counter()
+            queries = asyncio.run(collect())
+            elapsed = time.perf_counter() - start
+            assert g.keywords_degraded  # so cached_response doesn't keep the answer
+    finally:
+        keywords.stream_keywords_from_abstracts, app.config["OPENAI_TIMEOUT"] = stream, timeout
+    assert queries == keywords.local_keywords(papers) and elapsed < 0.5, elapsed
+    print(f"Fell back to local keywords after {elapsed:.2f}s")
+
+def test_response_cache():
+    import os
+    import tempfile
+    from app._cache import KeyValueCache, ResponseCache
+    from app.routes import response_cache_key
+
+    disk = KeyValueCache(os.path.join(tempfile.mkdtemp(), "responses.sqlite"), ttl=120, max_entries=10)
+    cache = ResponseCache(ttl=60, stale_ttl=60, max_bytes=10, disk=disk)
+    cache.put("a", "12345")
+    cache.put("b", "123456")  # "a" no longer fits in memory
+    cache.put("c", "é" * 6)  # 6 characters but 12 bytes: too big for memory, on disk only
+    assert cache._bytes == 6
+    assert list(cache._entries) == ["b"] and cache.get("a") == ("12345", True)  # back from disk
+    cache.ttl = 0
+    assert cache.get("b") == ("123456", False)  # stale
+    assert cache.start_refresh("b") and not cache.start_refresh("b")
+    cache.finish_refresh("b")
+    cache.stale_ttl = 0
+    assert cache.get("b") == (None, False)
+    assert (cache.hits, cache.stale_hits, cache.misses) == (1, 1, 1)
+
+    key = response_cache_key("/queries", {"queries": ["10.1000/A", "https://doi.org/10.1000/b"], "ranking": "npmi"})
+    same = {"queries": ["10.1000/b", "doi:10.1000/a", "10.1000/a"], "ranking": "npmi", "cache": False}
+    assert key == response_cache_key("/queries", same)
+    assert key != response_cache_key("/v1/colab", same)
+    assert key != response_cache_key("/queries", {**same, "include_unranked": True})
+    print("Response cache tiers, staleness and keys work")
+
+def test_openalex_limiter():
+    from email.utils import format_datetime
+    from datetime import datetime, timedelta, timezone
+    from app._openalex_client import TokenBucketLimiter, parse_retry_after
+
+    async def paced():
+        limiter = TokenBucketLimiter(rate=20, burst=2)
+        start = time.monotonic()
+        for _ in range(6):
+            await limiter.acquire()
+        burst_and_refill = time.monotonic() - start
+        limiter.block_for(0.2)
+        start = time.monotonic()
+        await limiter.acquire()
+        return limiter, burst_and_refill, time.monotonic() - start
+
+    limiter, burst_and_refill, blocked = asyncio.run(paced())
+    # 2 tokens up front, then 4 more at 20 per second
+    assert 0.18 <= burst_and_refill < 0.4, burst_and_refill
+    assert blocked >= 0.19, blocked
+    assert limiter.stats()["requests"] == 7 and limiter.stats()["throttled"] == 1
+
+    assert parse_retry_after("3") == 3.0 and parse_retry_after("-1") == 0.0
+    assert parse_retry_after(None) is None and parse_retry_after("soon") is None
+    in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < parse_retry_after(in_a_minute) <= 60
+    print(f"Limiter paced 6 requests in {burst_and_refill:.2f}s, held {blocked:.2f}s after a 429")
+
+def test_works_cache():
+    import os
+    import sqlite3
+    import tempfile
+    from app._cache import WorksCache
+
+    path = os.path.join(tempfile.mkdtemp(), "works.sqlite")
+    cache = WorksCache(path, ttl=60, max_bytes=10**6)
+    cache.put_many([{"id": "https://openalex.org/W1", "doi": "https://doi.org/10.1/A", "title": "one"}])
+    # Merging another field set keeps the older timestamp
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE works SET stored_at = stored_at - 30 WHERE id = 'W1'")
+    conn.commit()
+    cache.put_many_later([{"id": "W1", "publication_year": 2020}])
+    cache.flush()
+    assert cache.get_many(["W1"], "id,title,publication_year") == {
+        "W1": {"id": "W1", "title": "one", "publication_year": 2020}
+    }
+    assert cache.get_many_by_doi(["10.1/a"], "title") == {"10.1/a": {"title": "one"}}
+    cache.ttl = 25
+    assert cache.get_many(["W1"], "publication_year") == {}  # expired with the fields it was merged into
+    # A record with every cached field starts over
+    cache.put_many([{"id": "W1", "doi": "10.1/a", "title": "one", "publication_year": 2020}])
+    assert cache.get_many(["W1"], "publication_year") == {"W1": {"publication_year": 2020}}
+
+    # Least recently read works go first once the payloads exceed max_bytes
+    cache = WorksCache(os.path.join(tempfile.mkdtemp(), "works.sqlite"), ttl=60, max_bytes=10**6)
+    cache.put_many([{"id": f"W{i}", "title": os.urandom(300).hex()} for i in range(10)])
+    cache.get_many(["W0", "W1"], "title")
+    cache.flush()
+    size = sqlite3.connect(cache.path).execute("SELECT MAX(size) FROM works").fetchone()[0]
+    cache.max_bytes = 5 * size
+    cache.put_many([{"id": "W10", "title": os.urandom(300).hex()}])
+    left = set(cache.get_many([f"W{i}" for i in range(11)], "title"))
+    assert {"W0", "W1", "W10"} <= left and len(left) <= 5, left
+    recount = sqlite3.connect(cache.path).execute("SELECT SUM(size) FROM works").fetchone()[0]
+    assert cache.stats()["bytes"] == recount <= cache.max_bytes
+    print(f"Works cache merges, expires and evicts, {cache.stats()}")
+
+def test_citation_crawler():
+    from app._crawl import CitationCrawler
+    from app._dedup import WorkDeduper
+
+    # Layer 1 of two seeds, sharing the citer W100 and already holding W1-W4
+    citers = {
+        "W1": [{"id": "W100"}, {"id": "W101"}, {"id": "W2"}],
+        "W2": [{"id": "W100"}, {"id": "W102"}],
+        "W3": [{"id": f"W2{i:02d}"} for i in range(10)],
+        "W4": [{"id": "W101"}, {"id": "W103"}],
+    }
+    layer1 = [{"id": "W1", "cited_by_count": 5}, {"id": "W2", "cited_by_count": 50},
+              {"id": "W3", "cited_by_count": 1}, {"id": "W4", "cited_by_count": 20}]
+
+    def crawl(budget, workers, priority="citations", proximity=None):
+        visited = []
+
+        async def fetch_citers(work_id, max_results):
+            visited.append(work_id)
+            await asyncio.sleep(0.01)
+            return citers[work_id][:max_results]
+
+        deduper = WorkDeduper()
+        for paper in layer1:
+            deduper.add_paper(paper)
+        crawler = CitationCrawler(fetch_citers, budget=budget, workers=workers, priority=priority, deduper=deduper)
+        for paper in layer1:
+            crawler.enqueue(paper, proximity=(proximity or {}).get(paper["id"], 1))
+        assert not crawler.enqueue(layer1[0])
+        collected = asyncio.run(crawler.run())
+        return visited, [paper["id"] for paper in collected]
+
+    visited, collected = crawl(budget=100, workers=1)
+    assert visited == ["W2", "W4", "W1", "W3"]  # most cited first
+    # W100 and W101 are cited by two layer 1 works, W2 is in layer 1 already
+    assert collected == ["W100", "W102", "W101", "W103", *(f"W2{i:02d}" for i in range(10))]
+
+    visited, _ = crawl(budget=100, workers=1, priority="proximity", proximity={"W3": 2})
+    assert visited[0] == "W3"
+
+    for workers in (1, 4):
+        _, collected = crawl(budget=5, workers=workers)
+        assert len(collected) == 5 and len(set(collected)) == 5
+    print("CitationCrawler keeps to the budget, the priority order and dedups across seeds")
+
+def test_snapshot_store():
+    import gzip
+    import os
+    import tempfile
+    from app._snapshot import SnapshotStore
+
+    works = [
+        {"id": "https://openalex.org/W1", "doi": "https://doi.org/10.1/A", "title": "Graph neural networks",
+         "abstract_inverted_index": {"message": [1], "Graph": [0], "passing": [2]}, "cited_by_count": 10,
+         "referenced_works": []},
+        {"id": "https://openalex.org/W2", "doi": None, "title": "Protein folding", "cited_by_count": 3,
+         "abstract_inverted_index": None, "referenced_works": ["https://openalex.org/W1"]},
+        {"id": "https://openalex.org/W3", "doi": "10.1/c", "title": "Message passing for proteins",
+         "cited_by_count": 7, "referenced_works": ["https://openalex.org/W1", "https://openalex.org/W2"]},
+    ]
+    directory = tempfile.mkdtemp()
+    with gzip.open(os.path.join(directory, "part_000.gz"), "wt", encoding="utf-8") as partition:
+        partition.write("\n".join(json.dumps(work) for work in works) + "\n")
+    store = SnapshotStore(os.path.join(directory, "snapshot.sqlite"))
+    assert store.ingest([os.path.join(directory, "part_000.gz")]) == 3
+
+    w3, w1 = store.get_works(["W3", "https://openalex.org/W1", "W9"], fields="id,doi,title,referenced_works")
+    assert w1 == {"id": "https://openalex.org/W1", "doi": "https://doi.org/10.1/a",
+                  "title": "Graph neural networks", "referenced_works": []}
+    assert w3["referenced_works"] == ["https://openalex.org/W1", "https://openalex.org/W2"]
+    assert [w["id"] for w in store.get_works_by_doi(["10.1/A", "https://doi.org/10.1/C"], fields="id")] == [
+        "https://openalex.org/W1", "https://openalex.org/W3"]
+    assert store.get_works(["W1"])[0]["abstract_inverted_index"] == works[0]["abstract_inverted_index"]
+
+    count, citers = store.citers("W1", limit=1, fields="id,cited_by_count")
+    assert count == 2 and citers == [{"id": "https://openalex.org/W3", "cited_by_count": 7}]  # most cited first
+    assert store.citers("W1", limit=5, offset=1, fields="id")[1] == [{"id": "https://openalex.org/W2"}]
+    assert store.citers("W3", limit=5) == (0, [])
+
+    # Titles and abstracts are both searched
+    assert {w["id"][-2:] for w in store.search("message passing", 10, fields="id")} == {"W1", "W3"}
+    assert store.search("protein", 10, fields="title") == [{"title": "Protein folding"}]
+    assert store.search("?!", 10) == []
+    print("Snapshot store ingests a partition and answers lookups, citers and search")
+
 if __name__ == "__main__":
     recommendations = test_queries()
 
@@ -20,6 +20,43 @@ app.config['ZOTERO_CLIENT_SECRET'] = os.getenv('ZOTERO_CLIENT_SECRET')
 app.config['ZOTERO_CALLBACK_URL'] = os.getenv('ZOTERO_CALLBACK_URL')
 app.config['OPENAI_KEY'] = os.getenv('OPENAI_KEY')
 app.config['OPENALEX_EMAIL'] = os.getenv('OPENALEX_EMAIL')
+app.config['OPENALEX_MAX_CONNECTIONS'] = os.getenv('OPENALEX_MAX_CONNECTIONS', 100)
+app.config['OPENALEX_MAX_CONNECTIONS_PER_HOST'] = os.getenv('OPENALEX_MAX_CONNECTIONS_PER_HOST', 20)
+app.config['OPENALEX_DNS_TTL'] = os.getenv('OPENALEX_DNS_TTL', 300)  # seconds
+app.config['OPENALEX_TIMEOUT'] = os.getenv('OPENALEX_TIMEOUT', 30)  # seconds
+app.config['OPENALEX_RATE_LIMIT'] = os.getenv('OPENALEX_RATE_LIMIT', 10)  # requests/sec per worker process
+app.config['OPENALEX_RATE_BURST'] = os.getenv('OPENALEX_RATE_BURST', 10)
+app.config['OPENALEX_CACHE_ENABLED'] = os.getenv('OPENALEX_CACHE_ENABLED', 'true')
+app.config['OPENALEX_CACHE_PATH'] = os.getenv('OPENALEX_CACHE_PATH')  # defaults to instance/openalex_works.sqlite
+app.config['OPENALEX_CACHE_TTL'] = os.getenv('OPENALEX_CACHE_TTL', 7 * 24 * 3600)  # seconds
+app.config['OPENALEX_CACHE_MAX_MB'] = os.getenv('OPENALEX_CACHE_MAX_MB', 512)
+app.config['OPENALEX_CRAWL_WORKERS'] = os.getenv('OPENALEX_CRAWL_WORKERS', 8)
+app.config['TWO_PHASE_FETCH'] = os.getenv('TWO_PHASE_FETCH', 'true')
+app.config['OPENALEX_BACKEND'] = os.getenv('OPENALEX_BACKEND', 'api')  # 'api' or 'snapshot'
+app.config['OPENALEX_SNAPSHOT_PATH'] = os.getenv('OPENALEX_SNAPSHOT_PATH')  # defaults to instance/openalex_snapshot.sqlite
+app.config['INCREMENTAL_RANKING'] = os.getenv('INCREMENTAL_RANKING', 'false')  # rank /queries candidates as pages arrive
+app.config['NPMI_SOURCE'] = os.getenv('NPMI_SOURCE', 'request')  # 'request', 'prior' or 'blend'
+app.config['NPMI_PRIOR_PATH'] = os.getenv('NPMI_PRIOR_PATH')  # defaults to instance/npmi_prior
+app.config['NPMI_PRIOR_WEIGHT'] = os.getenv('NPMI_PRIOR_WEIGHT', 0.5)  # weight of the prior with NPMI_SOURCE=blend
+app.config['RANKING_WORKERS'] = os.getenv('RANKING_WORKERS', 2)  # ranking processes per worker, 0 ranks inline
+app.config['RANKING_INLINE_THRESHOLD'] = os.getenv('RANKING_INLINE_THRESHOLD', 1000)  # smaller inputs are ranked inline
+app.config['RANKING_WARM_POOL'] = os.getenv('RANKING_WARM_POOL', 'false')  # start the ranking processes with the server
+app.config['LEXICAL_HASH_BUCKETS'] = os.getenv('LEXICAL_HASH_BUCKETS', 2**20)  # BM25 term buckets per worker
+app.config['LEXICAL_MAX_DOCUMENTS'] = os.getenv('LEXICAL_MAX_DOCUMENTS', 200000)  # BM25 statistics are halved past this
+app.config['ABSTRACT_CACHE_SIZE'] = os.getenv('ABSTRACT_CACHE_SIZE', 20000)  # reconstructed abstracts kept per worker
+app.config['OPENAI_TIMEOUT'] = os.getenv('OPENAI_TIMEOUT', 30)  # seconds to wait for the first LLM query before falling back to local keywords
+app.config['LLM_CACHE_ENABLED'] = os.getenv('LLM_CACHE_ENABLED', 'true')
+app.config['LLM_CACHE_PATH'] = os.getenv('LLM_CACHE_PATH')  # defaults to instance/llm_queries.sqlite
+app.config['LLM_CACHE_TTL'] = os.getenv('LLM_CACHE_TTL', 30 * 24 * 3600)  # seconds
+app.config['LLM_CACHE_MAX_ENTRIES'] = os.getenv('LLM_CACHE_MAX_ENTRIES', 10000)
+app.config['RESPONSE_CACHE_ENABLED'] = os.getenv('RESPONSE_CACHE_ENABLED', 'true')
+app.config['RESPONSE_CACHE_TTL'] = os.getenv('RESPONSE_CACHE_TTL', 6 * 3600)  # seconds a response is served as fresh
+app.config['RESPONSE_CACHE_STALE_TTL'] = os.getenv('RESPONSE_CACHE_STALE_TTL', 24 * 3600)  # then served stale while refreshed
+app.config['RESPONSE_CACHE_MAX_MB'] = os.getenv('RESPONSE_CACHE_MAX_MB', 64)  # in memory, per worker
+app.config['RESPONSE_CACHE_PATH'] = os.getenv('RESPONSE_CACHE_PATH')  # on-disk tier, off unless set
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 10000)  # on disk
+app.config['STREAM_SNAPSHOT_INTERVAL'] = os.getenv('STREAM_SNAPSHOT_INTERVAL', 2.0)  # seconds between provisional results when streaming
+app.config['STREAM_PREVIEW_SIZE'] = os.getenv('STREAM_PREVIEW_SIZE', 20)  # papers in each provisional result
 app.config['EMAILS_SPREADSHEET_ID'] = os.getenv('EMAILS_SPREADSHEET_ID')
 app.config['FEEDBACK_SPREADSHEET_ID'] = os.getenv('FEEDBACK_SPREADSHEET_ID')
 
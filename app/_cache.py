@@ -0,0 +1,515 @@
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Iterable, Optional
+from app import app
+from app._identifiers import normalize_doi, normalize_openalex_id
+
+
+class WorksCache:
+    """On-disk cache of OpenAlex work records keyed by OpenAlex ID and DOI.
+
+    Records are stored zlib-compressed in SQLite. Entries older than the TTL
+    are ignored, and once the payloads exceed max_bytes the least recently
+    read works are evicted. A cached record is only served when it carries
+    every field the caller selects; records fetched with different field sets
+    are merged, keeping the older timestamp so that merged-in fields expire
+    with the record they came from.
+
+    Writes made while serving a request (put_many_later, and the access times
+    of reads) are queued and applied in batches by a writer thread with its
+    own connection, so responses never wait on them. The payload total is
+    kept as a running sum, recounted when expired works are swept.
+    """
+
+    def __init__(self, path: str, ttl: float, max_bytes: int, enabled: bool = True,
+                 sweep_interval: float = 300, max_pending: int = 1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.sweep_interval = sweep_interval
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._write_conn = None
+        self._write_lock = threading.Lock()
+        self._total_bytes = None
+        self._next_sweep = 0.0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._writer = None
+
+    def _open(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS works (
+                id TEXT PRIMARY KEY,
+                payload BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS works_accessed_at ON works(accessed_at);
+            CREATE INDEX IF NOT EXISTS works_stored_at ON works(stored_at);
+            CREATE TABLE IF NOT EXISTS work_dois (
+                doi TEXT PRIMARY KEY,
+                id TEXT NOT NULL
+            );
+            """
+        )
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = self._open()
+        return self._conn
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return zlib.compress(json.dumps(record, separators=(",", ":")).encode(), 6)
+
+    @staticmethod
+    def _decode(payload: bytes) -> dict:
+        return json.loads(zlib.decompress(payload))
+
+    @staticmethod
+    def _rows(conn, ids: list[str]) -> dict:
+        """id -> (payload, size, stored_at) of the stored works among ids, fresh or not"""
+        rows = {}
+        for i in range(0, len(ids), 500):  # stay under SQLite's bound-parameter limit
+            chunk = ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for work_id, payload, size, stored_at in conn.execute(
+                f"SELECT id, payload, size, stored_at FROM works WHERE id IN ({placeholders})", chunk
+            ):
+                rows[work_id] = (payload, size, stored_at)
+        return rows
+
+    def get_many(self, openalex_ids: Iterable[str], fields: str) -> dict:
+        """Cached records for the given IDs that carry every selected field, keyed by short ID"""
+        if not self.enabled:
+            return {}
+        ids = list(dict.fromkeys(filter(None, map(normalize_openalex_id, openalex_ids))))
+        if not ids:
+            return {}
+        wanted = fields.split(",")
+        cutoff = time.time() - self.ttl
+        try:
+            with self._lock:
+                rows = self._rows(self._connect(), ids)
+        except sqlite3.Error as e:
+            app.logger.error(f"Works cache read failed: {str(e)}")
+            return {}
+        found = {}
+        for work_id, (payload, _, stored_at) in rows.items():
+            if stored_at < cutoff:
+                continue
+            record = self._decode(payload)
+            if all(f in record for f in wanted):
+                found[work_id] = {f: record[f] for f in wanted}
+        if found:
+            self._enqueue(("touch", list(found), time.time()))
+        self.hits += len(found)
+        self.misses += len(ids) - len(found)
+        return found
+
+    def get_many_by_doi(self, dois: Iterable[str], fields: str) -> dict:
+        """Cached records for the given DOIs that carry every selected field, keyed by normalized DOI"""
+        if not self.enabled:
+            return {}
+        dois = list(dict.fromkeys(filter(None, map(normalize_doi, dois))))
+        if not dois:
+            return {}
+        try:
+            with self._lock:
+                conn = self._connect()
+                doi_ids = {}
+                for i in range(0, len(dois), 500):
+                    chunk = dois[i:i + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    doi_ids.update(conn.execute(
+                        f"SELECT doi, id FROM work_dois WHERE doi IN ({placeholders})", chunk
+                    ))
+        except sqlite3.Error as e:
+            app.logger.error(f"Works cache read failed: {str(e)}")
+            return {}
+        by_id = self.get_many(doi_ids.values(), fields)
+        self.misses += len(dois) - len(doi_ids)
+        return {doi: by_id[work_id] for doi, work_id in doi_ids.items() if work_id in by_id}
+
+    @staticmethod
+    def _project(records: Iterable[dict], fields: Optional[set]) -> dict:
+        """Copies of the records keyed by short ID, projected to fields"""
+        incoming = {}
+        for record in records:
+            work_id = normalize_openalex_id(record.get("id"))
+            if not work_id:
+                continue
+            incoming.setdefault(work_id, {}).update(
+                (k, v) for k, v in record.items() if fields is None or k in fields
+            )
+        return incoming
+
+    def put_many(self, records: Iterable[dict], fields: Optional[set] = None):
+        """Store records (projected to fields) right away, merging with fresh cached versions of the same work"""
+        if not self.enabled:
+            return
+        incoming = self._project(records, fields)
+        if incoming:
+            self._write(incoming, {})
+
+    def put_many_later(self, records: Iterable[dict], fields: Optional[set] = None):
+        """put_many on the writer thread; returns at once, and drops the write if the queue is full"""
+        if not self.enabled:
+            return
+        incoming = self._project(records, fields)
+        if incoming:
+            self._enqueue(("put", incoming))
+
+    def _enqueue(self, item: tuple):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="works-cache-writer", daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                app.logger.warning(f"Works cache write queue is full, {self.dropped} writes dropped")
+
+    def _write_loop(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < 64:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            incoming, touched = {}, {}
+            for item in items:
+                if item[0] == "put":
+                    for work_id, record in item[1].items():
+                        incoming.setdefault(work_id, {}).update(record)
+                else:
+                    touched.update(dict.fromkeys(item[1], item[2]))
+            try:
+                self._write(incoming, touched)
+            except Exception as e:
+                app.logger.error(f"Works cache write failed: {str(e)}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Wait until every queued write has been applied"""
+        self._queue.join()
+
+    def _write(self, incoming: dict, touched: dict):
+        try:
+            with self._write_lock:
+                if self._write_conn is None:
+                    self._write_conn = self._open()
+                conn = self._write_conn
+                if self._total_bytes is None:
+                    self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM works").fetchone()[0]
+                now = time.time()
+                cutoff = now - self.ttl
+                existing = self._rows(conn, list(incoming))
+                rows, doi_rows = [], []
+                for work_id, record in incoming.items():
+                    stored_at = now
+                    if work_id in existing:
+                        payload, size, old_stored_at = existing[work_id]
+                        self._total_bytes -= size
+                        if old_stored_at >= cutoff:
+                            cached = self._decode(payload)
+                            if not set(cached) <= set(record):
+                                stored_at = old_stored_at
+                            record = {**cached, **record}
+                    payload = self._encode(record)
+                    self._total_bytes += len(payload)
+                    rows.append((work_id, payload, len(payload), stored_at, now))
+                    doi = normalize_doi(record.get("doi"))
+                    if doi:
+                        doi_rows.append((doi, work_id))
+                conn.executemany("INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?, ?)", rows)
+                conn.executemany("INSERT OR REPLACE INTO work_dois VALUES (?, ?)", doi_rows)
+                conn.executemany(
+                    "UPDATE works SET accessed_at = ? WHERE id = ?",
+                    [(accessed_at, work_id) for work_id, accessed_at in touched.items()],
+                )
+                conn.commit()
+                if now >= self._next_sweep or self._total_bytes > self.max_bytes:
+                    self._evict(conn)
+        except sqlite3.Error as e:
+            app.logger.error(f"Works cache write failed: {str(e)}")
+
+    def _evict(self, conn: sqlite3.Connection):
+        removed = 0
+        now = time.time()
+        if now >= self._next_sweep:
+            removed += conn.execute("DELETE FROM works WHERE stored_at < ?", (now - self.ttl,)).rowcount
+            # Other workers write to the same file: recount now and then instead of on every write
+            self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM works").fetchone()[0]
+            self._next_sweep = now + self.sweep_interval
+        if self._total_bytes > self.max_bytes:
+            # Drop least recently read works until we're back under 90% of the budget
+            target = self._total_bytes - int(self.max_bytes * 0.9)
+            evicted, freed = [], 0
+            for work_id, size in conn.execute("SELECT id, size FROM works ORDER BY accessed_at"):
+                evicted.append((work_id,))
+                freed += size
+                if freed >= target:
+                    break
+            conn.executemany("DELETE FROM works WHERE id = ?", evicted)
+            self._total_bytes -= freed
+            removed += len(evicted)
+            app.logger.info(f"Works cache evicted {len(evicted)} works ({freed / 10**6:.1f}MB)")
+        if removed:
+            conn.execute("DELETE FROM work_dois WHERE id NOT IN (SELECT id FROM works)")
+        conn.commit()
+
+    def iter_records(self):
+        """Every cached record, fresh or not (for offline jobs such as build-npmi-prior)"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            for (payload,) in conn.execute("SELECT payload FROM works"):
+                yield self._decode(payload)
+        finally:
+            conn.close()
+
+    async def aget_many(self, openalex_ids: Iterable[str], fields: str) -> dict:
+        return await asyncio.to_thread(self.get_many, list(openalex_ids), fields)
+
+    async def aget_many_by_doi(self, dois: Iterable[str], fields: str) -> dict:
+        return await asyncio.to_thread(self.get_many_by_doi, list(dois), fields)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled, "hits": self.hits, "misses": self.misses,
+            "bytes": self._total_bytes, "pending": self._queue.qsize(), "dropped": self.dropped,
+        }
+
+
+class KeyValueCache:
+    """Small on-disk cache of JSON values keyed by string (e.g. a content hash).
+
+    Entries older than the TTL are ignored and purged on write; past
+    max_entries the least recently read ones are evicted.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, enabled: bool = True):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    payload BLOB NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries(accessed_at);
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str):
+        """Fresh cached value for key, None if there is none"""
+        if not self.enabled:
+            return None
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT payload FROM entries WHERE key = ? AND stored_at >= ?", (key, time.time() - self.ttl)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                    conn.commit()
+        except sqlite3.Error as e:
+            app.logger.error(f"Cache read failed ({self.path}): {str(e)}")
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, value):
+        if not self.enabled:
+            return
+        payload = zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)
+        try:
+            with self._lock:
+                conn = self._connect()
+                now = time.time()
+                conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, payload, now, now))
+                conn.execute("DELETE FROM entries WHERE stored_at < ?", (now - self.ttl,))
+                # Least recently read entries past max_entries
+                conn.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            app.logger.error(f"Cache write failed ({self.path}): {str(e)}")
+
+    async def aget(self, key: str):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, value):
+        await asyncio.to_thread(self.put, key, value)
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses}
+
+
+class ResponseCache:
+    """Recommendation response bodies in memory, optionally backed by a KeyValueCache on disk.
+
+    An entry is fresh for ttl seconds and stale for stale_ttl more: stale
+    entries are still served while the caller refreshes them in the
+    background (stale-while-revalidate), expired ones are misses. The memory
+    tier evicts the least recently used bodies past max_bytes (UTF-8 encoded).
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_bytes: int, disk: Optional[KeyValueCache] = None,
+                 enabled: bool = True):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.enabled = enabled
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, body, size)
+        self._bytes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, stored_at: float, body: str):
+        size = len(body.encode())
+        with self._lock:
+            self._forget(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (stored_at, body, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def _forget(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def get(self, key: str) -> tuple[Optional[str], bool]:
+        """Cached body for key and whether it is still fresh; (None, False) on a miss"""
+        if not self.enabled:
+            return None, False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.disk is not None:
+            stored = self.disk.get(key)
+            if stored is not None:
+                entry = (stored["stored_at"], stored["body"])
+                self._remember(key, *entry)
+        age = time.time() - entry[0] if entry is not None else float("inf")
+        with self._lock:
+            if age >= self.ttl + self.stale_ttl:
+                self._forget(key)
+                self.misses += 1
+                return None, False
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1], True
+            self.stale_hits += 1
+            return entry[1], False
+
+    def put(self, key: str, body: str):
+        if not self.enabled:
+            return
+        stored_at = time.time()
+        self._remember(key, stored_at, body)
+        if self.disk is not None:
+            self.disk.put(key, {"stored_at": stored_at, "body": body})
+
+    def start_refresh(self, key: str) -> bool:
+        """Claim the refresh of a stale entry; False if one is already running"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def finish_refresh(self, key: str):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled, "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+            "entries": len(self._entries), "bytes": self._bytes,
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
+
+
+works_cache = WorksCache(
+    path=app.config["OPENALEX_CACHE_PATH"] or os.path.join(app.instance_path, "openalex_works.sqlite"),
+    ttl=float(app.config["OPENALEX_CACHE_TTL"]),
+    max_bytes=int(float(app.config["OPENALEX_CACHE_MAX_MB"]) * 10**6),
+    enabled=str(app.config["OPENALEX_CACHE_ENABLED"]).lower() == "true",
+)
+
+# Search queries generated by the LLM, keyed by a hash of the model and prompt (see _openai.py)
+llm_cache = KeyValueCache(
+    path=app.config["LLM_CACHE_PATH"] or os.path.join(app.instance_path, "llm_queries.sqlite"),
+    ttl=float(app.config["LLM_CACHE_TTL"]),
+    max_entries=int(app.config["LLM_CACHE_MAX_ENTRIES"]),
+    enabled=str(app.config["LLM_CACHE_ENABLED"]).lower() == "true",
+)
+
+# Whole /queries and /v1/colab responses (see cached_response in routes.py); on disk only with RESPONSE_CACHE_PATH
+response_cache = ResponseCache(
+    ttl=float(app.config["RESPONSE_CACHE_TTL"]),
+    stale_ttl=float(app.config["RESPONSE_CACHE_STALE_TTL"]),
+    max_bytes=int(float(app.config["RESPONSE_CACHE_MAX_MB"]) * 10**6),
+    disk=KeyValueCache(
+        path=app.config["RESPONSE_CACHE_PATH"],
+        ttl=float(app.config["RESPONSE_CACHE_TTL"]) + float(app.config["RESPONSE_CACHE_STALE_TTL"]),
+        max_entries=int(app.config["RESPONSE_CACHE_MAX_ENTRIES"]),
+    ) if app.config["RESPONSE_CACHE_PATH"] else None,
+    enabled=str(app.config["RESPONSE_CACHE_ENABLED"]).lower() == "true",
+)
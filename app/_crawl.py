@@ -0,0 +1,103 @@
+import asyncio
+import heapq
+import itertools
+from typing import Awaitable, Callable, Optional
+from app import app
+from app._dedup import WorkDeduper
+from app._identifiers import normalize_openalex_id
+
+CRAWL_PRIORITIES = ("citations", "proximity")
+
+
+class CitationCrawler:
+    """Bounded crawl over the cited-by listings of a frontier of works.
+
+    Works are pulled from a priority frontier (most cited first, or closest
+    to the seeds first) by a fixed number of workers. Every work is
+    deduplicated by OpenAlex ID when it is enqueued, and against deduper (a
+    WorkDeduper that may be shared with the caller) when collected. Once the
+    global paper budget is used up, the remaining workers are cancelled.
+
+    fetch_citers(work_id, max_results) returns the works citing work_id.
+    Every citation seen on the way is kept in edges as (citing, cited) IDs.
+    """
+
+    def __init__(self, fetch_citers: Callable[[str, int], Awaitable[list[dict]]], budget: int,
+                 workers: int = 8, per_source: int = 50, priority: str = "citations",
+                 deduper: Optional[WorkDeduper] = None):
+        if priority not in CRAWL_PRIORITIES:
+            raise ValueError(f"Unknown crawl priority: {priority}")
+        self.fetch_citers = fetch_citers
+        self.budget = budget
+        self.workers = workers
+        self.per_source = per_source
+        self.priority = priority
+        self.remaining = budget
+        self.collected = []
+        self.edges = []
+        self._frontier = []
+        self._enqueued = set()
+        self.deduper = deduper if deduper is not None else WorkDeduper()
+        self._counter = itertools.count()  # tie-breaker keeps the heap stable
+        self._tasks = []
+
+    def enqueue(self, paper: dict, proximity: int = 1) -> bool:
+        """Add a work to the frontier; returns False if it was already enqueued"""
+        work_id = normalize_openalex_id(paper.get("id"))
+        if not work_id or work_id in self._enqueued:
+            return False
+        self._enqueued.add(work_id)
+        cited_by_count = paper.get("cited_by_count") or 0
+        if self.priority == "citations":
+            key = (-cited_by_count, -proximity)
+        else:
+            key = (-proximity, -cited_by_count)
+        heapq.heappush(self._frontier, (key, next(self._counter), work_id))
+        return True
+
+    def __len__(self):
+        return len(self._frontier)
+
+    def _collect(self, papers: list[dict], cited_id: str):
+        self.edges.extend((paper.get("id"), cited_id) for paper in papers)
+        for paper in papers:
+            if self.remaining <= 0:
+                return
+            if not normalize_openalex_id(paper.get("id")) or not self.deduper.add_paper(paper):
+                continue
+            self.collected.append(paper)
+            self.remaining -= 1
+
+    async def _worker(self):
+        while self._frontier and self.remaining > 0:
+            _, _, work_id = heapq.heappop(self._frontier)
+            try:
+                papers = await self.fetch_citers(work_id, min(self.per_source, self.remaining))
+            except Exception as e:
+                app.logger.error(f"Error crawling citations of {work_id}: {str(e)}")
+                continue
+            self._collect(papers, work_id)
+        if self.remaining <= 0:
+            # Budget reached: stop everyone still waiting on a fetch
+            current = asyncio.current_task()
+            for task in self._tasks:
+                if task is not current:
+                    task.cancel()
+
+    async def run(self) -> list[dict]:
+        if self.remaining <= 0 or not self._frontier:
+            return self.collected
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        app.logger.info(
+            f"Crawl collected {len(self.collected)} papers, {len(self._frontier)} sources left unexplored"
+        )
+        return self.collected
+
+
+def per_source_limit(budget: int, sources: int, minimum: int = 50, maximum: int = 200) -> int:
+    """Cited-by results to request per frontier work: an even share of the budget, but never a tiny page"""
+    if sources <= 0:
+        return minimum
+    share = -(-budget // sources)  # ceil
+    return max(minimum, min(maximum, share))
@@ -0,0 +1,64 @@
+import threading
+from typing import Iterable, List, Optional
+import numpy as np
+import pandas as pd
+from app._identifiers import normalize_doi, normalize_openalex_id
+
+
+class WorkDeduper:
+    """Streaming set of the works seen so far, keyed by OpenAlex ID.
+
+    DOIs are a secondary index: a work whose ID is new but whose DOI was
+    already seen under another ID (merged or duplicated OpenAlex records) is
+    a duplicate too. Works without a DOI are told apart by ID alone, so they
+    no longer collapse into one. Meant to be applied to each page as it is
+    parsed, before anything is put in a DataFrame.
+    """
+
+    def __init__(self):
+        self._ids = set()
+        self._dois = {}  # normalized DOI -> OpenAlex ID
+        self._lock = threading.Lock()
+
+    def add(self, work_id: Optional[str], doi: Optional[str] = None) -> bool:
+        """Record a work; returns False if it was seen before"""
+        work_id, doi = normalize_openalex_id(work_id), normalize_doi(doi)
+        with self._lock:
+            if (work_id and work_id in self._ids) or (doi and doi in self._dois):
+                return False
+            if work_id:
+                self._ids.add(work_id)
+            if doi:
+                self._dois[doi] = work_id
+            return True
+
+    def add_paper(self, paper: dict) -> bool:
+        return self.add(paper.get("id"), paper.get("doi"))
+
+    def filter(self, papers: Iterable[dict]) -> List[dict]:
+        """The papers not seen before, in order (duplicates within papers included)"""
+        return [paper for paper in papers if self.add_paper(paper)]
+
+    def __contains__(self, work_id: str) -> bool:
+        return normalize_openalex_id(work_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def first_occurrences(results: pd.DataFrame) -> np.ndarray:
+    """Boolean mask of the rows that are the first occurrence of their work"""
+    missing = pd.Series([None] * len(results), index=results.index, dtype=object)
+    deduper = WorkDeduper()
+    return np.fromiter(
+        (deduper.add(work_id, doi) for work_id, doi in zip(results.get("id", missing), results.get("doi", missing))),
+        dtype=bool, count=len(results),
+    )
+
+
+def doi_mask(results: pd.DataFrame, dois: Iterable[str]) -> np.ndarray:
+    """Boolean mask of the rows whose DOI is one of dois, however either side is spelled"""
+    wanted = set(filter(None, map(normalize_doi, dois)))
+    if not wanted or "doi" not in results:
+        return np.zeros(len(results), dtype=bool)
+    return np.fromiter((normalize_doi(doi) in wanted for doi in results["doi"]), dtype=bool, count=len(results))
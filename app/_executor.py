@@ -0,0 +1,156 @@
+import asyncio
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Callable, List, Optional
+import pandas as pd
+from app import app
+from app._identifiers import normalize_openalex_id
+from app._lexical import LexicalIndex, bm25_scores, lexical_index, lexical_inputs
+from app._openalex import abstract_cache, reconstruct_abstracts
+from app._pagerank import CitationGraph, candidate_pagerank, personalized_pagerank
+from app._topicmod import (
+    blend_scores,
+    candidate_rows,
+    pair_scores,
+    request_pair_scores,
+    resolve_npmi_source,
+    top_ranked,
+    topic_csr,
+)
+
+
+def warm_up() -> int:
+    """No-op task: unpickling it makes a pool process import the ranking code"""
+    return os.getpid()
+
+
+class RankingExecutor:
+    """Process pool for the CPU-bound parts of a request (NPMI, BM25 and PageRank ranking, abstracts).
+
+    Inputs smaller than inline_threshold, or every input when workers is 0,
+    are computed inline on the calling thread: shipping them to another
+    process would cost more than it saves. The pool uses the spawn start
+    method and belongs to the process that created it, so each gunicorn
+    worker gets its own. Spawned processes import the whole app before their
+    first task; a server calls warm() at startup so no request pays for that.
+    """
+
+    def __init__(self, workers: int, inline_threshold: int):
+        self.workers = workers
+        self.inline_threshold = inline_threshold
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            # A pool created before a fork (gunicorn --preload) belongs to the parent
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                self._pid = os.getpid()
+            return self._pool
+
+    def warm(self):
+        """Start every pool process now, in the background"""
+        if self.workers <= 0:
+            return
+        pool = self._get_pool()
+        for _ in range(self.workers):
+            pool.submit(warm_up)
+
+    async def run(self, size: int, fn: Callable, *args):
+        """fn(*args) in the pool, or inline for inputs below the threshold"""
+        if self.workers <= 0 or size < self.inline_threshold:
+            return fn(*args)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_pool(), partial(fn, *args))
+        except BrokenProcessPool as e:
+            app.logger.error(f"Ranking process pool broke, running inline: {str(e)}")
+            with self._lock:
+                self._pool = None
+            return fn(*args)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                # Processes still importing the app would hold up the exit until they are done
+                processes = list((getattr(self._pool, "_processes", None) or {}).values())
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                for process in processes:
+                    process.terminate()
+                self._pool = None
+
+
+ranking_executor = RankingExecutor(
+    workers=int(app.config["RANKING_WORKERS"]),
+    inline_threshold=int(app.config["RANKING_INLINE_THRESHOLD"]),
+)
+# concurrent.futures joins its pools in a threading exit hook, before atexit handlers run:
+# register there too (hooks run last-registered first) so processes still starting are stopped, not awaited
+getattr(threading, "_register_atexit", atexit.register)(ranking_executor.shutdown)
+# Whether the server should call ranking_executor.warm() when it starts (see refbro.py); importing never does
+WARM_POOL = str(app.config["RANKING_WARM_POOL"]).lower() == "true"
+
+
+async def rank_results_async(results: pd.DataFrame, top_k=20, exclude_dois: List[str] = None,
+                             npmi_source: str = "request", prior=None, prior_weight: float = 0.5) -> pd.DataFrame:
+    """rank_results with the per-request NPMI scoring sent to the ranking process pool.
+
+    Only the CSR topic arrays and candidate positions cross the process
+    boundary; the DataFrame stays here. Prior lookups are cheap and run
+    inline.
+    """
+    npmi_source = resolve_npmi_source(npmi_source, prior)
+    offsets, indices = topic_csr(results)
+    rows = candidate_rows(results, exclude_dois)
+    request_scores = prior_scores = None
+    if npmi_source in ("request", "blend"):
+        request_scores = await ranking_executor.run(len(results), request_pair_scores, offsets, indices, rows)
+    if npmi_source in ("prior", "blend"):
+        prior_scores = pair_scores(prior.lookup, offsets, indices, rows)
+    scores = blend_scores(npmi_source, request_scores, prior_scores, prior_weight)
+    return top_ranked(results, rows, scores, top_k)
+
+
+async def rank_by_lexical_async(results: pd.DataFrame, seeds: pd.DataFrame, top_k=20, exclude_dois: List[str] = None,
+                                index: LexicalIndex = lexical_index) -> pd.DataFrame:
+    """rank_by_lexical with the BM25 product sent to the ranking process pool.
+
+    Tokenizing stays here, as it feeds the shared index statistics: only the
+    sparse term counts of the candidates, their document frequencies and the
+    seed terms cross the process boundary.
+    """
+    rows, inputs = lexical_inputs(results, seeds, exclude_dois, index)
+    scores = await ranking_executor.run(len(rows), bm25_scores, *inputs)
+    return top_ranked(results, rows, scores, top_k, descending=True)
+
+
+async def rank_by_pagerank_async(results: pd.DataFrame, graph: CitationGraph, top_k=20,
+                                 exclude_dois: List[str] = None, damping: float = 0.85) -> pd.DataFrame:
+    """rank_by_pagerank with the power iteration sent to the ranking process pool (the sparse adjacency and seed nodes)"""
+    scores = await ranking_executor.run(
+        len(graph.index), personalized_pagerank, graph.adjacency(), graph.seed_nodes(), damping
+    )
+    rows, candidate_scores = candidate_pagerank(results, graph, scores, exclude_dois)
+    return top_ranked(results, rows, candidate_scores, top_k, descending=True)
+
+
+async def reconstruct_abstracts_async(indexes: List[Optional[dict]], work_ids: List[Optional[str]]) -> List[str]:
+    """reconstruct_abstracts with the abstract cache looked up here and only the misses sent to the pool"""
+    abstracts = [abstract_cache.get(normalize_openalex_id(i) if isinstance(i, str) else None) for i in work_ids]
+    misses = [n for n, abstract in enumerate(abstracts) if abstract is None]
+    if misses:
+        rebuilt = await ranking_executor.run(len(misses), reconstruct_abstracts, [indexes[n] for n in misses])
+        for n, abstract in zip(misses, rebuilt):
+            abstracts[n] = abstract
+            if isinstance(indexes[n], dict) and isinstance(work_ids[n], str):
+                abstract_cache.put(normalize_openalex_id(work_ids[n]), abstract)
+    return abstracts
@@ -0,0 +1,32 @@
+from typing import Optional
+
+DOI_PREFIXES = (
+    "https://doi.org/",
+    "http://doi.org/",
+    "https://dx.doi.org/",
+    "http://dx.doi.org/",
+    "doi:",
+)
+
+
+def normalize_doi(doi: Optional[str]) -> Optional[str]:
+    """Bare, lowercase DOI (10.xxxx/...) from any of the usual spellings"""
+    if not isinstance(doi, str):
+        return None
+    doi = doi.strip()
+    lowered = doi.lower()
+    for prefix in DOI_PREFIXES:
+        if lowered.startswith(prefix):
+            doi = doi[len(prefix):]
+            break
+    doi = doi.strip().lower()
+    return doi or None
+
+
+def normalize_openalex_id(openalex_id: Optional[str]) -> Optional[str]:
+    """Short, uppercase OpenAlex ID (W123...) from a full https://openalex.org/ URL or a bare ID"""
+    if not isinstance(openalex_id, str):
+        return None
+    openalex_id = openalex_id.strip().rstrip("/")
+    openalex_id = openalex_id.rsplit("/", 1)[-1]
+    return openalex_id.upper() or None
@@ -0,0 +1,167 @@
+import asyncio
+import math
+import re
+from collections import Counter, defaultdict
+from typing import AsyncIterator, Iterable, List
+import pandas as pd
+from flask import g, has_app_context
+from app import app
+from app._openai import stream_keywords_from_abstracts
+from app._openalex import abstract_inputs, reconstruct_abstracts
+from app.prompting.systemprompts import keywords_out
+
+KEYWORD_MODES = ("llm", "fast")
+
+WORD = re.compile(r"[a-z][a-z0-9]*(?:-[a-z0-9]+)*")
+# Punctuation that ends a phrase; words are only joined within a fragment
+PHRASE_BREAK = re.compile(r"[.,;:!?()\[\]{}\"/]|\s[-–—]\s")
+
+STOPWORDS = frozenset("""
+a about above across after again against all almost along also although always am among an and another any are
+around as at be because been before being below between both but by can cannot could did do does doing done down
+due during each either else enough especially etc even ever every few for from further had has have having here
+how however if in into is it its itself just least less like made make makes many may might more most much must
+near nearly neither no nor not now of off often on once one only onto or other others otherwise our out over own
+per perhaps rather same several shall should since so some such than that the their them themselves then there
+therefore these they this those though through thus to too toward towards under until upon us use used uses using
+very via was we well were what whatever when where whether which while who whom whose why will with within without
+would yet you your
+""".split())
+
+# Words every abstract uses that say nothing about the topic
+GENERIC_WORDS = frozenset("""
+abstract analysis approach approaches article based case cases demonstrate demonstrated demonstrates describe
+described effect effects evidence examine examined existing experiment experiments find finding findings first
+found framework general given high however important including increase introduce introduced investigate
+investigated key large low main method methods model models new novel obtained paper particular present presented
+presents previous problem problems propose proposed provide provided provides recent recently related report
+reported research result results second set show showed shown shows significant significantly similar simple
+studied studies study suggest suggests system systems task tasks technique techniques terms three two type types
+understanding various way ways work works
+""".split())
+
+
+def stem(word: str) -> str:
+    """Crude plural folding, so "network" and "networks" count as one word"""
+    if len(word) > 4 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def candidate_phrases(text: str, max_words: int = 3) -> Iterable[tuple]:
+    """RAKE candidates: runs of content words between stopwords and punctuation, cut to max_words"""
+    for fragment in PHRASE_BREAK.split(text.lower()):
+        run = []
+        for word in WORD.findall(fragment) + [""]:
+            if len(word) > 2 and word not in STOPWORDS and word not in GENERIC_WORDS:
+                run.append(word)
+                continue
+            for start in range(0, len(run), max_words):
+                yield tuple(run[start:start + max_words])
+            run = []
+
+
+def score_phrases(documents: List[tuple]) -> List[tuple]:
+    """Candidate phrases of the (title, abstract) documents, best first, with the documents they occur in.
+
+    Words are scored by their RAKE degree (the words they share candidate
+    phrases with, occurrences included), a phrase by its words' mean.
+    Phrases found in several of the seed papers are boosted, as are those in
+    titles (counted twice), so the queries follow what the reading list has
+    in common rather than one long abstract.
+    """
+    degree, occurrences, phrase_docs, surface = Counter(), Counter(), defaultdict(set), {}
+    for n, (title, abstract) in enumerate(documents):
+        for text, weight in ((title, 2), (abstract, 1)):
+            for phrase in candidate_phrases(text):
+                key = tuple(map(stem, phrase))
+                if len(set(key)) < len(key):
+                    continue
+                surface.setdefault(key, phrase)
+                occurrences[key] += weight
+                phrase_docs[key].add(n)
+                for word in key:
+                    degree[word] += weight * len(key)
+    n_documents = max(len(documents), 1)
+    scores = {
+        key: sum(degree[w] for w in key) / len(key)
+        * (1 + len(phrase_docs[key]) / n_documents)
+        * (1 + math.log(occurrences[key]))
+        for key in occurrences
+    }
+    ranked = sorted(scores, key=lambda key: (-scores[key], surface[key]))
+    return [(key, surface[key], phrase_docs[key]) for key in ranked]
+
+
+def assemble_queries(phrases: List[tuple], n_queries: int, min_words: int = 3, max_words: int = 5) -> List[str]:
+    """Queries of min_words to max_words words, each led by one of the top phrases.
+
+    Leading phrases contained in a better one are skipped. A query is filled
+    with the best phrases from the same seed papers as its leading phrase,
+    then with the best phrases overall, never repeating a word.
+    """
+    queries, leads = {}, []
+    for lead_key, lead, lead_docs in phrases:
+        if len(queries) == n_queries:
+            break
+        # "neural network" adds nothing to a query already led by "graph neural network"
+        if any(set(lead_key) <= set(key) for key in leads):
+            continue
+        leads.append(lead_key)
+        stems, words = set(lead_key), list(lead)
+        for related_only in (True, False):
+            for key, phrase, docs in phrases:
+                if len(words) >= min_words:
+                    break
+                if (related_only and not docs & lead_docs) or stems & set(key) or len(words) + len(phrase) > max_words:
+                    continue
+                stems.update(key)
+                words.extend(phrase)
+        # The same words in another order make the same search
+        queries.setdefault(frozenset(stems), " ".join(words))
+    return list(queries.values())
+
+
+def local_keywords(papers: pd.DataFrame, n_queries: int = keywords_out) -> List[str]:
+    """Search queries for the papers extracted from their titles and abstracts, without the LLM"""
+    if "abstract" not in papers:
+        papers = papers.assign(abstract=reconstruct_abstracts(*abstract_inputs(papers)))
+    titles = papers["title"] if "title" in papers else [""] * len(papers)
+    documents = [
+        (title if isinstance(title, str) else "", abstract if abstract != "MISSING_ABSTRACT" else "")
+        for title, abstract in zip(titles, papers["abstract"])
+    ]
+    queries = assemble_queries(score_phrases(documents), n_queries)
+    app.logger.info(f"Extracted {len(queries)} search queries locally")
+    return queries
+
+
+async def keyword_queries(papers: pd.DataFrame, mode: str = "llm", use_cache: bool = True) -> AsyncIterator[str]:
+    """Search queries for the papers, from the LLM or, with mode="fast", from local_keywords.
+
+    local_keywords is also the fallback when the LLM fails or has not
+    written a query within OPENAI_TIMEOUT seconds; once some queries came
+    through, an error is raised as before. A fallback sets
+    g.keywords_degraded in the request.
+    """
+    if mode == "fast":
+        for query in local_keywords(papers):
+            yield query
+        return
+    queries = stream_keywords_from_abstracts(papers, use_cache=use_cache)
+    try:
+        # The whole wait, however many chunks trickle in: the client's timeout is per read
+        async with asyncio.timeout(float(app.config["OPENAI_TIMEOUT"])):
+            query = await anext(queries, None)
+    except Exception as e:
+        await queries.aclose()
+        app.logger.warning(f"Falling back to local keyword extraction: {str(e) or type(e).__name__}")
+        if has_app_context():
+            # A stand-in for the LLM's answer, not worth caching (see app.routes.cached_response)
+            g.keywords_degraded = True
+        for query in local_keywords(papers):
+            yield query
+        return
+    while query is not None:
+        yield query
+        query = await anext(queries, None)
@@ -0,0 +1,174 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from itertools import chain, repeat
+from typing import Iterable, List, Optional
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from app import app
+from app._dedup import doi_mask, first_occurrences
+from app._identifiers import normalize_openalex_id
+from app._topicmod import top_ranked
+
+TOKEN = re.compile(r"\w{2,}")
+
+
+class LexicalIndex:
+    """Process-wide BM25 statistics over the abstracts ranked so far.
+
+    Terms are hashed into a fixed number of buckets, so the document
+    frequencies take constant memory whatever the vocabulary. The document
+    frequencies and average document length grow incrementally as requests
+    bring in new works (each work is counted once), so the IDF is never
+    refit from scratch. Past max_documents the statistics are halved and the
+    older half of the seen works forgotten, which keeps them bounded and
+    leaning towards recent traffic. Term frequencies are read straight from
+    OpenAlex abstract inverted indexes, without rebuilding the abstract text.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, buckets: int = 2**20,
+                 max_documents: int = 200000, max_words: int = 200000):
+        self.k1 = k1
+        self.b = b
+        self.buckets = buckets
+        self.max_documents = max_documents
+        self.max_words = max_words
+        self._words = {}
+        self.document_frequency = np.zeros(buckets, dtype=np.float32)
+        self.documents = 0.0
+        self.total_length = 0.0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _word_terms(self, word: str) -> tuple:
+        """Term buckets of a raw inverted-index word ("Learning," -> learning), memoized"""
+        terms = tuple(zlib.crc32(token.encode()) % self.buckets for token in TOKEN.findall(word.lower()))
+        if len(self._words) >= self.max_words:
+            self._words = {}
+        self._words[word] = terms
+        return terms
+
+    def term_counts(self, indexes: Iterable[Optional[dict]]) -> tuple[sparse.csr_matrix, np.ndarray]:
+        """Sparse documents x term buckets counts and document lengths of abstract inverted indexes"""
+        cols, values, sizes = [], [], []
+        words = self._words
+        for index in indexes:
+            if not isinstance(index, dict):
+                sizes.append(0)
+                continue
+            terms = [words.get(word) for word in index]
+            # Words without any token memoize an empty tuple: only None is a miss
+            if None in terms:
+                terms = [known if known is not None else self._word_terms(word) for word, known in zip(index, terms)]
+                words = self._words  # _word_terms may have started a new table
+            per_word = list(map(len, terms))
+            cols.extend(chain.from_iterable(terms))
+            values.extend(chain.from_iterable(map(repeat, map(len, index.values()), per_word)))
+            sizes.append(sum(per_word))
+        n_documents = len(sizes)
+        rows = np.repeat(np.arange(n_documents), sizes)
+        # Words normalizing to the same term are summed by the CSR conversion
+        counts = sparse.csr_matrix(
+            (np.array(values, dtype=np.float64), (rows, np.array(cols, dtype=np.int64))),
+            shape=(n_documents, self.buckets),
+        )
+        return counts, np.asarray(counts.sum(axis=1)).ravel()
+
+    def add_documents(self, work_ids: List[str], counts: sparse.csr_matrix, lengths: np.ndarray):
+        """Fold documents not seen before into the document frequencies"""
+        with self._lock:
+            new = [i for i, work_id in enumerate(work_ids) if work_id and work_id not in self._seen]
+            if not new:
+                return
+            self._seen.update(dict.fromkeys(work_ids[i] for i in new))
+            present = counts[new].copy()
+            present.data[:] = 1
+            self.document_frequency += np.asarray(present.sum(axis=0)).ravel().astype(np.float32)
+            self.documents += len(new)
+            self.total_length += float(lengths[new].sum())
+            if len(self._seen) > self.max_documents:
+                self._decay()
+
+    def _decay(self):
+        """Halve the statistics and forget the older half of the seen works"""
+        self.document_frequency *= 0.5
+        self.documents *= 0.5
+        self.total_length *= 0.5
+        for _ in range(len(self._seen) // 2):
+            self._seen.popitem(last=False)
+
+    def score_inputs(self, candidates: List[Optional[dict]], candidate_ids: List[str],
+                     seeds: List[Optional[dict]], seed_ids: List[str]) -> tuple:
+        """Arguments of bm25_scores for the candidates against the seeds, folding both into the statistics"""
+        candidate_counts, candidate_lengths = self.term_counts(candidates)
+        seed_counts, seed_lengths = self.term_counts(seeds)
+        self.add_documents(candidate_ids, candidate_counts, candidate_lengths)
+        self.add_documents(seed_ids, seed_counts, seed_lengths)
+        with self._lock:
+            # The frequencies of the terms the candidates use, not the whole table
+            frequency = self.document_frequency[candidate_counts.indices].astype(np.float64)
+            documents, average_length = self.documents, self.total_length / max(self.documents, 1)
+        queries = (seed_counts > 0).astype(np.float64)
+        return candidate_counts, candidate_lengths, frequency, documents, average_length, queries, self.k1, self.b
+
+    def similarity(self, candidates: List[Optional[dict]], candidate_ids: List[str],
+                   seeds: List[Optional[dict]], seed_ids: List[str]) -> np.ndarray:
+        """Mean BM25 score of each candidate abstract against every seed abstract taken as a query"""
+        return bm25_scores(*self.score_inputs(candidates, candidate_ids, seeds, seed_ids))
+
+    def stats(self) -> dict:
+        return {"terms": int(np.count_nonzero(self.document_frequency)), "documents": round(self.documents),
+                "seen": len(self._seen), "words": len(self._words)}
+
+
+def bm25_scores(counts: sparse.csr_matrix, lengths: np.ndarray, frequency: np.ndarray, documents: float,
+                average_length: float, queries: sparse.csr_matrix, k1: float, b: float) -> np.ndarray:
+    """Mean BM25 score of each document against every query (rows of term indicators).
+
+    frequency holds the document frequency of each stored count of counts.
+    Works on sparse arrays only, so it can run in a worker process (see _executor.py).
+    """
+    if queries.shape[0] == 0:
+        return np.zeros(counts.shape[0])
+    idf = np.log1p((documents - frequency + 0.5) / (frequency + 0.5))
+    tf = counts.data
+    norm = 1 - b + b * np.repeat(lengths, np.diff(counts.indptr)) / max(average_length, 1e-9)
+    weights = sparse.csr_matrix(
+        (idf * tf * (k1 + 1) / (tf + k1 * norm), counts.indices, counts.indptr), shape=counts.shape
+    )
+    return np.asarray((weights @ queries.T).mean(axis=1)).ravel()
+
+
+lexical_index = LexicalIndex(
+    buckets=int(app.config["LEXICAL_HASH_BUCKETS"]),
+    max_documents=int(app.config["LEXICAL_MAX_DOCUMENTS"]),
+)
+
+
+def lexical_inputs(results: pd.DataFrame, seeds: pd.DataFrame, exclude_dois: List[str] = None,
+                   index: LexicalIndex = lexical_index) -> tuple[np.ndarray, tuple]:
+    """Positions of the candidates to score and the bm25_scores arguments for them"""
+    seed_ids = [normalize_openalex_id(i) for i in seeds.get("id", pd.Series(dtype=object))]
+    ids = results["id"].map(normalize_openalex_id)
+    # Drop duplicates, input DOIs and the seed works themselves
+    keep = first_occurrences(results) & ~ids.isin(seed_ids).to_numpy()
+    if exclude_dois:
+        keep &= ~doi_mask(results, exclude_dois)
+    rows = np.flatnonzero(keep)
+    inputs = index.score_inputs(
+        results.iloc[rows].get("abstract_inverted_index", pd.Series([None] * len(rows))).tolist(),
+        ids.iloc[rows].tolist(),
+        seeds.get("abstract_inverted_index", pd.Series(dtype=object)).tolist(),
+        seed_ids,
+    )
+    app.logger.info(f"Lexical ranking of {len(rows)} candidates against {len(seed_ids)} seeds, index {index.stats()}")
+    return rows, inputs
+
+
+def rank_by_lexical(results: pd.DataFrame, seeds: pd.DataFrame, top_k=20, exclude_dois: List[str] = None,
+                    index: LexicalIndex = lexical_index) -> pd.DataFrame:
+    """Rank candidates by BM25 similarity of their abstracts to the seed abstracts, highest first"""
+    rows, inputs = lexical_inputs(results, seeds, exclude_dois, index)
+    return top_ranked(results, rows, bm25_scores(*inputs), top_k, descending=True)
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+from typing import Iterable, Optional
+import click
+import numpy as np
+from scipy import sparse
+from app import app
+from app._topicmod import topic_vocabulary
+
+PRIOR_PATH = app.config["NPMI_PRIOR_PATH"] or os.path.join(app.instance_path, "npmi_prior")
+
+
+class NpmiPrior:
+    """Corpus-level topic NPMI, built offline by `flask build-npmi-prior`.
+
+    Stored as three files in one directory: keys.npy holds the sorted pair
+    keys i * T + j (i < j) over the prior's own topic indices, values.npy the
+    NPMI of each pair and topics.json the topic IDs of those indices. The
+    arrays are memory-mapped read-only, so every gunicorn worker shares the
+    same pages instead of holding a copy.
+    """
+
+    def __init__(self, keys: np.ndarray, values: np.ndarray, topics: list[str], meta: Optional[dict] = None):
+        self.keys = keys
+        self.values = values
+        self.topics = topics
+        self.meta = meta or {}
+        self._topic_index = {topic: i for i, topic in enumerate(topics)}
+        # Process topic vocabulary index -> prior index (-1 if the prior never saw the topic)
+        self._vocabulary_map = np.empty(0, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "NpmiPrior":
+        with open(os.path.join(path, "topics.json")) as f:
+            meta = json.load(f)
+        keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        return cls(keys, values, meta.pop("topics"), meta)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        # Written under temporary names and swapped in, running workers keep their old mapping
+        for name, array in (("keys.npy", self.keys), ("values.npy", self.values)):
+            np.save(os.path.join(path, f"tmp.{name}"), array)
+            os.replace(os.path.join(path, f"tmp.{name}"), os.path.join(path, name))
+        with open(os.path.join(path, "tmp.topics.json"), "w") as f:
+            json.dump({**self.meta, "topics": self.topics}, f)
+        os.replace(os.path.join(path, "tmp.topics.json"), os.path.join(path, "topics.json"))
+
+    def _prior_indices(self, vocabulary_indices: np.ndarray) -> np.ndarray:
+        size = len(topic_vocabulary)
+        with self._lock:
+            known = len(self._vocabulary_map)
+            if known < size:
+                added = topic_vocabulary.decode(range(known, size))
+                self._vocabulary_map = np.concatenate([
+                    self._vocabulary_map,
+                    np.fromiter((self._topic_index.get(t, -1) for t in added), dtype=np.int64, count=len(added)),
+                ])
+            mapping = self._vocabulary_map
+        return mapping[vocabulary_indices]
+
+    def lookup(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """NPMI of the topic pairs (a[i], b[i]), given as topic vocabulary indices; 0 for unseen pairs"""
+        if not len(self.keys):
+            return np.zeros(len(a))
+        pa, pb = self._prior_indices(a), self._prior_indices(b)
+        low, high = np.minimum(pa, pb), np.maximum(pa, pb)
+        keys = low * len(self.topics) + high
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (low >= 0) & (low != high) & (self.keys[positions] == keys)
+        return np.where(found, self.values[positions], 0.0)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def build_npmi_prior(records: Iterable[dict], min_count: int = 2, chunk_size: int = 100000) -> NpmiPrior:
+    """Topic NPMI over a stream of works (records with OpenAlex topic dicts).
+
+    Co-occurrences are accumulated chunk by chunk as X^T X of a binary
+    works x topics incidence matrix. Probabilities are normalized by the
+    number of works with at least one topic; pairs seen fewer than
+    min_count times are left out.
+    """
+    topic_index = {}
+    counts = sparse.csr_matrix((0, 0), dtype=np.int64)
+    n_works = 0
+    chunk = []
+
+    def flush():
+        nonlocal counts
+        if not chunk:
+            return
+        size = len(topic_index)
+        lengths = [len(ids) for ids in chunk]
+        incidence = sparse.csr_matrix(
+            (np.ones(sum(lengths), dtype=np.int64), np.concatenate(chunk), np.concatenate([[0], np.cumsum(lengths)])),
+            shape=(len(chunk), size),
+        )
+        counts.resize((size, size))
+        counts = counts + (incidence.T @ incidence).tocsr()
+        chunk.clear()
+
+    for record in records:
+        topics = record.get("topics") if record else None
+        if not topics:
+            continue
+        ids = sorted({topic_index.setdefault(t["id"], len(topic_index)) for t in topics})
+        chunk.append(np.array(ids, dtype=np.int64))
+        n_works += 1
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+
+    counts = sparse.triu(counts, format="coo")
+    diagonal = counts.diagonal().astype(np.float64)
+    pairs = (counts.row != counts.col) & (counts.data >= min_count)
+    i, j, c_ij = counts.row[pairs], counts.col[pairs], counts.data[pairs].astype(np.float64)
+    p_ij = c_ij / max(n_works, 1)
+    p_i, p_j = diagonal[i] / max(n_works, 1), diagonal[j] / max(n_works, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        npmi = np.where(p_ij >= 1, 1.0, np.log2(p_ij / (p_i * p_j)) / (-np.log2(p_ij)))
+
+    keys = i.astype(np.int64) * len(topic_index) + j
+    order = np.argsort(keys)
+    topics = [None] * len(topic_index)
+    for topic, index in topic_index.items():
+        topics[index] = topic
+    meta = {"works": n_works, "pairs": int(len(keys)), "min_count": min_count, "built_at": time.time()}
+    return NpmiPrior(keys[order], npmi[order].astype(np.float32), topics, meta)
+
+
+npmi_prior = None
+if os.path.exists(os.path.join(PRIOR_PATH, "topics.json")):
+    try:
+        npmi_prior = NpmiPrior.load(PRIOR_PATH)
+        app.logger.info(f"Loaded NPMI prior with {len(npmi_prior)} topic pairs from {PRIOR_PATH}")
+    except (OSError, ValueError, KeyError) as e:
+        app.logger.error(f"Could not load the NPMI prior from {PRIOR_PATH}: {str(e)}")
+
+
+@app.cli.command("build-npmi-prior")
+@click.option("--source", type=click.Choice(["snapshot", "cache"]), default="snapshot",
+              help="Works to count topics over: the local snapshot store or the works cache")
+@click.option("--db", default=None, help="Snapshot store or works cache path, defaults to the configured one")
+@click.option("--out", default=None, help="Output directory, defaults to NPMI_PRIOR_PATH")
+@click.option("--min-count", default=2, show_default=True, help="Minimum co-occurrences for a pair to be kept")
+def build_prior(source, db, out, min_count):
+    """Compute the corpus-level topic NPMI prior used by rank_results."""
+    if source == "snapshot":
+        from app._snapshot import SnapshotStore, SNAPSHOT_PATH
+        store = SnapshotStore(db or SNAPSHOT_PATH)
+    else:
+        from app._cache import WorksCache, works_cache
+        store = WorksCache(db or works_cache.path, ttl=float("inf"), max_bytes=works_cache.max_bytes)
+    start = time.time()
+    prior = build_npmi_prior(store.iter_records(), min_count=min_count)
+    prior.save(out or PRIOR_PATH)
+    click.echo(
+        f"Built NPMI prior over {prior.meta['works']} works: {len(prior.topics)} topics, "
+        f"{len(prior)} pairs in {time.time() - start:.0f}s into {out or PRIOR_PATH}"
+    )
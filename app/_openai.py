@@ -1,20 +1,31 @@
+import hashlib
 import os
+import re
+from typing import AsyncIterator
 from dotenv import load_dotenv
 import pandas as pd
 
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from app import app
+from app._cache import llm_cache
+from app._openalex import abstract_inputs, reconstruct_abstracts
 from app.prompting.systemprompts import *
 
-client_oai = OpenAI(api_key=app.config["OPENAI_KEY"])
+# No retries: a failed or slow answer is abandoned for the local extractor (see app._keywords)
+client_oai_async = AsyncOpenAI(
+    api_key=app.config["OPENAI_KEY"], timeout=float(app.config["OPENAI_TIMEOUT"]), max_retries=0
+)
+KEYWORD_MODEL = "gpt-4o"
 
 class SearchList(BaseModel):
     queries: list[str]
 
 
 def format_abstracts_for_oai_userprompt(papers: pd.DataFrame) -> str:
+    if "abstract" not in papers:
+        papers = papers.assign(abstract=reconstruct_abstracts(*abstract_inputs(papers)))
     papers = papers[papers["abstract"] != "MISSING_ABSTRACT"]
     user_prompt = "\n------\n".join(
         f"title:: {pap['title']}\nabstract:: {pap['abstract']}"
@@ -22,26 +33,74 @@ def format_abstracts_for_oai_userprompt(papers: pd.DataFrame) -> str:
         ) + "\n------\n"
     return user_prompt
 
-def keywords_from_abstracts(papers: pd.DataFrame):
+def keyword_messages(papers: pd.DataFrame) -> list[dict]:
     user_prompt = format_abstracts_for_oai_userprompt(papers)
+    return [
+        {
+            "role": "system", 
+            "content": f"{system_prompt_1}"
+        },
+        {
+            "role": "user", 
+            "content": f"{user_prompt}"
+        },
+    ]
+
+def keyword_cache_key(messages: list[dict], model: str = KEYWORD_MODEL) -> str:
+    """sha256 of the model, the system prompt and the normalized user prompt.
+
+    The user prompt is normalized by collapsing whitespace and sorting the
+    title/abstract blocks, so the same reading list in another order hits
+    the same entry.
+    """
+    system_prompt, user_prompt = messages[0]["content"], messages[1]["content"]
+    blocks = sorted(
+        block for block in (re.sub(r"\s+", " ", b).strip() for b in user_prompt.split("\n------\n")) if block
+    )
+    content = "\x00".join([model, system_prompt, *blocks])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+async def stream_keywords_from_abstracts(papers: pd.DataFrame, use_cache: bool = True) -> AsyncIterator[str]:
+    """Search queries for the papers, streamed from the SearchList output.
+
+    Each query is yielded as soon as the model has finished writing it, so
+    the searches can start while the rest is still being generated. Cached
+    queries are yielded right away; use_cache=False skips the lookup (a
+    fresh answer still gets stored).
+    """
+    messages = keyword_messages(papers)
+    key = keyword_cache_key(messages)
+    cached = await llm_cache.aget(key) if use_cache else None
+    if cached:
+        app.logger.info(f"Reusing {len(cached)} cached search queries")
+        for query in cached:
+            yield query
+        return
+    emitted = 0
     try:
-        app.logger.info("Sending request to OpenAI API")
-        completion = client_oai.beta.chat.completions.parse(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": f"{system_prompt_1}"
-                },
-                {
-                    "role": "user", 
-                    "content": f"{user_prompt}"
-                },
-            ],
+        app.logger.info("Streaming request to OpenAI API")
+        async with client_oai_async.beta.chat.completions.stream(
+            model=KEYWORD_MODEL,
+            messages=messages,
             response_format=SearchList,
-        )
-        app.logger.info(f"Generated {len(completion.choices[0].message.parsed.queries)} search queries")
-        return completion.choices[0].message.parsed.queries
-    except Exception as e: 
+        ) as stream:
+            async for event in stream:
+                if event.type == "content.delta":
+                    # Partially parsed JSON: every query but the last one is complete
+                    partial = event.parsed if isinstance(event.parsed, dict) else {}
+                    complete = (partial.get("queries") or [])[:-1]
+                elif event.type == "content.done":
+                    complete = event.parsed.queries if event.parsed else []
+                else:
+                    continue
+                for query in complete[emitted:]:
+                    yield query
+                emitted = max(emitted, len(complete))
+            completion = await stream.get_final_completion()
+        queries = completion.choices[0].message.parsed.queries if completion.choices[0].message.parsed else []
+        app.logger.info(f"Generated {len(queries)} search queries")
+        if queries:
+            await llm_cache.aput(key, queries)
+    except Exception as e:
         app.logger.error(f"OpenAI API error: {str(e)}")
-        raise
\ No newline at end of file
+        raise
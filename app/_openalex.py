@@ -1,15 +1,31 @@
-from typing import Optional
+from collections import Counter, OrderedDict
+from functools import partial
+from itertools import chain
+from typing import AsyncIterator, Optional, Union
 import pandas as pd
+import random
+import threading
 import aiohttp
 import asyncio
 from app import app
+from app._openalex_client import openalex_client
+from app._identifiers import normalize_doi, normalize_openalex_id
+from app._cache import works_cache
+from app._crawl import CitationCrawler, per_source_limit
+from app._dedup import WorkDeduper
+from app._pagerank import CitationGraph
+from app._snapshot import snapshot_store, cited_work_from_url
+from app._topicmod import IncrementalRanker, topic_vocabulary
 
 BASE_OPENALEX = "https://api.openalex.org"
-OPENALEX_EMAIL = app.config["OPENALEX_EMAIL"]
+OPENALEX_MAX_OR_VALUES = 100  # values allowed in one OR (|) filter
+OPENALEX_MAX_PAGED_RESULTS = 10000  # page-based paging stops here, deeper listings need a cursor
 
 # FIELDS TO FETCH FROM OPENALEX
 doi_minimal_fields = ",".join(
         [
+            "id",
+            "doi",
             "cited_by_api_url",
             "referenced_works"
         ]
@@ -17,39 +33,66 @@ doi_minimal_fields = ",".join(
 
 paper_fields = ",".join(
         [
+            "id",
             "title",
             "abstract_inverted_index",
             "doi",
             "authorships",
             "publication_year",
             "primary_location",
-            "topics"
+            "topics",
+            "cited_by_count"
         ]
     )
 
-async def fetch_with_retry(session, url: str, max_retries: int = 6, initial_delay: float = 1.0) -> Optional[dict]:
+# Minimal projection for candidate collection: all rank_results needs (plus the
+# crawl priority). The heavy fields are hydrated for the top-k only.
+ranking_fields = ",".join(
+        [
+            "id",
+            "doi",
+            "topics",
+            "cited_by_count"
+        ]
+    )
+
+# Candidate projection for the lexical ranking, which also needs the abstracts
+lexical_fields = ",".join([ranking_fields, "abstract_inverted_index"])
+
+# Fields kept in the local works cache
+cache_fields = set(paper_fields.split(",")) | set(doi_minimal_fields.split(","))
+
+def backoff_delay(attempt: int, initial_delay: float, max_delay: float) -> float:
+    """Full-jitter exponential backoff so retrying callers don't fire in lockstep"""
+    return random.uniform(0, min(max_delay, initial_delay * (2 ** attempt)))
+
+async def fetch_with_retry(url: str, params: Optional[dict] = None, max_retries: int = 6, initial_delay: float = 1.0,
+                           max_delay: float = 10.0, not_found_ok: bool = False) -> Optional[dict]:
     logger = app.logger
-    delay = initial_delay
     
     for attempt in range(max_retries):
         try:
-            async with session.get(url) as response:
-                if response.status == 429:  # Rate limit hit
-                    if attempt < max_retries - 1:  # Don't sleep on last attempt
-                        wait_time = delay * (2 ** attempt)  # Exponential backoff
-                        logger.info(f"Rate limit hit, waiting {wait_time:.1f}s before retry {attempt + 1}/{max_retries}")
-                        await asyncio.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error("Rate limit hit and max retries exceeded")
-                        raise Exception("OpenAlex rate limit reached after max retries")
-                
-                response.raise_for_status()
-                return await response.json()
-                
+            return await openalex_client.get_json(url, params, not_found_ok=not_found_ok)
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:  # Rate limit hit
+                if attempt < max_retries - 1:  # Don't sleep on last attempt
+                    # The client already holds every caller back for Retry-After,
+                    # only spread the retries out a little
+                    wait_time = backoff_delay(0, initial_delay, max_delay)
+                    logger.info(f"Rate limit hit, retrying in {wait_time:.1f}s ({attempt + 1}/{max_retries})")
+                    await asyncio.sleep(wait_time)
+                    continue
+                logger.error("Rate limit hit and max retries exceeded")
+                raise Exception("OpenAlex rate limit reached after max retries")
+            if e.status < 500 or attempt == max_retries - 1:  # Client errors won't go away by retrying
+                logger.error(f"Request failed: {str(e)}")
+                raise
+            wait_time = backoff_delay(attempt, initial_delay, max_delay)
+            logger.warning(f"Request failed, retrying in {wait_time:.1f}s ({attempt + 1}/{max_retries}): {str(e)}")
+            await asyncio.sleep(wait_time)
         except Exception as e:
             if attempt < max_retries - 1:
-                wait_time = delay * (2 ** attempt)
+                wait_time = backoff_delay(attempt, initial_delay, max_delay)
                 logger.warning(f"Request failed, retrying in {wait_time:.1f}s ({attempt + 1}/{max_retries}): {str(e)}")
                 await asyncio.sleep(wait_time)
             else:
@@ -58,238 +101,400 @@ async def fetch_with_retry(session, url: str, max_retries: int = 6, initial_dela
     
     return None
 
-async def fetch_papers_async(query: str, n_results=200, per_page=200):
-    logger = app.logger
-    query = "%20".join(query.split(" "))
-    try:
-        async with aiohttp.ClientSession() as session:
-            tasks = [] 
-            pages = (n_results + per_page - 1) // per_page
-            
-            for page in range(1, pages + 1):
-                url = f"{BASE_OPENALEX}/works?search={query}&select={paper_fields}&per-page={per_page}&page={page}&mailto={OPENALEX_EMAIL}"
-                tasks.append(fetch_with_retry(session, url))
-            
-            logger.info(f"Making {len(tasks)} requests to OpenAlex")
-            responses = await asyncio.gather(*tasks, return_exceptions=True)
-            results = []
-            
-            for response in responses:
-                if isinstance(response, Exception):
-                    logger.error(f"Request failed: {str(response)}")
-                    continue
-                if response:  # Skip None responses
-                    results.extend(response['results'])
-                    
-            logger.info(f"Retrieved {len(results)} papers from OpenAlex")
-            return pd.DataFrame(results) if results else pd.DataFrame()
-            
-    except Exception as e:
-        logger.error(f"Problem with fetching papers: {str(e)}")
-        raise
+async def search_snapshot(query: str, n_results: int, fields: str) -> list[dict]:
+    results = await asyncio.to_thread(snapshot_store.search, query, n_results, 0, fields)
+    return [with_topic_ids(paper) for paper in results]
+
+async def fetch_search_page(query: str, page: int, per_page: int, fields: str = paper_fields) -> list[dict]:
+    """One page of OpenAlex search results, with interned topic_ids"""
+    params = {"search": query, "select": fields, "per-page": per_page, "page": page}
+    response = await fetch_with_retry(f"{BASE_OPENALEX}/works", params)
+    results = response['results'] if response else []
+    works_cache.put_many_later(results, cache_fields)
+    return [with_topic_ids(paper) for paper in results]
 
 # TODO: move to openalex.py
-async def multi_search(queries: list[str], n_results=200, per_page=200) -> pd.DataFrame:
+async def multi_search(queries: Union[list[str], AsyncIterator[str]], n_results=200, per_page=200,
+                       fields: str = paper_fields) -> pd.DataFrame:
     logger = app.logger
     try:
-        # Create tasks for all queries at once
-        tasks = [fetch_papers_async(query, n_results=n_results, per_page=per_page) for query in queries]
-        # Execute all queries in parallel
-        results = await asyncio.gather(*tasks)
-        return pd.concat(results, ignore_index=True)
+        # Every page of every query requested concurrently, as soon as the query is known
+        pages = {}
+        async for position, papers in iter_search_pages(queries, n_results=n_results, per_page=per_page, fields=fields):
+            pages[position] = papers
+        results = [pages[position] for position in sorted(pages)]
+        # A work found by several queries is kept once, where it first shows up in query order
+        unique = WorkDeduper().filter(chain.from_iterable(results))
+        logger.info(f"{len(unique)} unique papers out of {sum(map(len, results))} search results")
+        return pd.DataFrame(unique) if unique else pd.DataFrame()
     except Exception as e: 
         # app.logger.info(f"Problem with multi_search: {str(e)}")
         logger.info(f"Problem with multi_search: {str(e)}")
         return pd.DataFrame()
 
+async def iter_search_pages(queries: Union[list[str], AsyncIterator[str]], n_results=200, per_page=200,
+                            fields: str = paper_fields) -> AsyncIterator[tuple[int, list[dict]]]:
+    """Search result pages of every query, in the order they complete (failed pages are skipped).
+
+    queries may be an async iterator (see stream_keywords_from_abstracts):
+    the searches of each query start as soon as it arrives, while the next
+    ones are still being produced. Each page comes with its position in
+    (query, page) order, the order multi_search keeps.
+    """
+    pages = (n_results + per_page - 1) // per_page
+    finished = asyncio.Queue()  # (position, task) of each completed search, None once every query is in
+    tasks = []
+
+    def dispatch(query_index: int, query: str):
+        if snapshot_store is not None:
+            searches = [search_snapshot(query, pages * per_page, fields)]
+        else:
+            searches = [fetch_search_page(query, page, per_page, fields) for page in range(1, pages + 1)]
+        for page, search in enumerate(searches):
+            task = asyncio.ensure_future(search)
+            task.add_done_callback(partial(lambda position, done: finished.put_nowait((position, done)),
+                                           query_index * pages + page))
+            tasks.append(task)
+
+    async def feed():
+        query_index = 0
+        try:
+            async for query in queries:
+                dispatch(query_index, query)
+                query_index += 1
+        finally:
+            finished.put_nowait(None)
+
+    if isinstance(queries, list):
+        for query_index, query in enumerate(queries):
+            dispatch(query_index, query)
+        finished.put_nowait(None)
+        feeder = None
+    else:
+        feeder = asyncio.ensure_future(feed())
+
+    try:
+        fed, handled = False, 0
+        while not fed or handled < len(tasks):
+            item = await finished.get()
+            if item is None:
+                fed = True
+                continue
+            handled += 1
+            position, task = item
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                app.logger.error(f"Request failed: {str(task.exception())}")
+                continue
+            yield position, task.result()
+        if feeder is not None and feeder.exception() is not None:
+            # Queries that did arrive were searched; without any, there is nothing to return
+            if not tasks:
+                raise feeder.exception()
+            app.logger.error(f"Query stream failed, searched the queries received so far: {str(feeder.exception())}")
+    finally:
+        # Stopped early (or failed): nothing left running in the background
+        for task in tasks + ([feeder] if feeder is not None else []):
+            task.cancel()
+
+async def multi_search_incremental(queries: Union[list[str], AsyncIterator[str]], ranker: IncrementalRanker, n_results=200, per_page=200,
+                                   fields: str = paper_fields) -> int:
+    """multi_search that feeds each page to the ranker as soon as it arrives.
+
+    Ranking a page overlaps with the requests still in flight, and no
+    combined DataFrame of every result is ever built. Works already fed by an
+    earlier page are left out. Returns the number of papers received.
+    """
+    received = 0
+    deduper = WorkDeduper()
+    async for _, papers in iter_search_pages(queries, n_results=n_results, per_page=per_page, fields=fields):
+        received += len(papers)
+        ranker.add(deduper.filter(papers))
+    app.logger.info(f"Ranked {ranker.candidates} candidates out of {received} papers as they arrived")
+    return received
+
 async def get_paper_network_info(doi: str) -> Optional[dict]:
     """Get only citation network information for a paper"""
     base_doi = "https://doi.org"
     clean_doi = doi.replace("https://doi.org/", "").replace("http://doi.org/", "")
     doi_url = f"{base_doi}/{clean_doi}"
-    url = f"{BASE_OPENALEX}/works/{doi_url}?select={doi_minimal_fields}&mailto={OPENALEX_EMAIL}"
+    url = f"{BASE_OPENALEX}/works/{doi_url}"
     
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                if response.status == 404:
-                    app.logger.warning(f"DOI not found in OpenAlex: {doi_url}")
-                    return None
-                
-                response.raise_for_status()
-                return await response.json()
-                
-        except Exception as e:
-            app.logger.error(f"Error fetching network info for DOI {doi}: {str(e)}")
-            raise
+    try:
+        if snapshot_store is not None:
+            works = await asyncio.to_thread(snapshot_store.get_works_by_doi, [clean_doi], doi_minimal_fields)
+            if not works:
+                app.logger.warning(f"DOI not found in OpenAlex: {doi_url}")
+            return works[0] if works else None
+
+        cached = await works_cache.aget_many_by_doi([clean_doi], doi_minimal_fields)
+        if cached:
+            return next(iter(cached.values()))
+
+        network_info = await fetch_with_retry(url, {"select": doi_minimal_fields}, not_found_ok=True)
+        if network_info is None:
+            app.logger.warning(f"DOI not found in OpenAlex: {doi_url}")
+        else:
+            works_cache.put_many_later([network_info], cache_fields)
+        return network_info
+            
+    except Exception as e:
+        app.logger.error(f"Error fetching network info for DOI {doi}: {str(e)}")
+        raise
 
-async def fetch_papers_batch(openalex_ids: list[str]) -> list[dict]:
-    """Fetch paper metadata for a batch of OpenAlex IDs"""
+async def fetch_papers_batch(openalex_ids: list[str], fields: str = paper_fields) -> list[dict]:
+    """Fetch paper metadata for a batch of (at most OPENALEX_MAX_OR_VALUES) OpenAlex IDs"""
     if not openalex_ids:
         return []
-        
-    ids_filter = "|".join(openalex_ids)
-    url = f"{BASE_OPENALEX}/works?filter=openalex_id:{ids_filter}&select={paper_fields}&mailto={OPENALEX_EMAIL}"
     
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                data = await response.json()
-                results = data.get('results', [])
-                
-                for paper in results:
-                    # Ensure topics is a list
-                    if 'topics' not in paper:
-                        paper['topics'] = []
-                    
-                    if "abstract_inverted_index" not in paper:
-                        paper["abstract"] = "MISSING_ABSTRACT"
-                    else:
-                        paper["abstract"] = reconstruct_abstract(paper["abstract_inverted_index"])
-                        
-                return results
+    try:
+        if snapshot_store is not None:
+            return prepare_papers(await asyncio.to_thread(snapshot_store.get_works, openalex_ids, fields))
+
+        cached = await works_cache.aget_many(openalex_ids, fields)
+        missing = [i for i in openalex_ids if normalize_openalex_id(i) not in cached]
+        fetched = {}
+        if missing:
+            ids_filter = "|".join(missing)
+            # per-page must cover the batch, the default of 25 would silently cut it off
+            params = {"filter": f"openalex_id:{ids_filter}", "select": fields, "per-page": len(missing)}
+            data = await fetch_with_retry(f"{BASE_OPENALEX}/works", params)
+            works_cache.put_many_later(data.get('results', []), cache_fields)
+            fetched = {normalize_openalex_id(paper.get("id")): paper for paper in data.get('results', [])}
+
+        # Input order, cached works and freshly fetched ones alike
+        results = []
+        for work_id in dict.fromkeys(map(normalize_openalex_id, openalex_ids)):
+            paper = cached.get(work_id) or fetched.get(work_id)
+            if paper is not None:
+                results.append(paper)
                 
+        return prepare_papers(results)
+            
+    except Exception as e:
+        app.logger.error(f"Error fetching batch of papers: {str(e)}")
+        raise
+
+def with_topic_ids(paper: dict) -> dict:
+    """Copy of the paper with its topic dicts replaced by interned int32 topic_ids"""
+    paper = dict(paper)
+    paper["topic_ids"] = topic_vocabulary.encode(paper.pop("topics", None))
+    return paper
+
+def prepare_papers(papers: list[dict]) -> list[dict]:
+    """Copies of the papers with the derived fields the ranking expects.
+
+    Responses may be shared with other callers of the client, so they are
+    never modified in place. Abstracts are not rebuilt here: only the works
+    that are returned or sent to the LLM need them (see reconstruct_abstracts).
+    """
+    return [with_topic_ids(paper) for paper in papers]
+
+async def fetch_cited_by_cursor(cited_by_url: str, max_results: int, per_page: int, fields: str) -> list[dict]:
+    """Walk a cited_by listing with cursor pagination (needed past OpenAlex's 10,000 result paging limit)"""
+    results = []
+    cursor = "*"
+    while cursor and len(results) < max_results:
+        try:
+            data = await fetch_with_retry(cited_by_url, {"cursor": cursor, "per-page": per_page, "select": fields})
         except Exception as e:
-            app.logger.error(f"Error fetching batch of papers: {str(e)}")
-            raise
+            app.logger.error(f"Error fetching cited_by papers: {str(e)}")
+            break
+        if not data.get('results'):
+            break
+        works_cache.put_many_later(data['results'], cache_fields)
+        results.extend(prepare_papers(data['results']))
+        cursor = data.get('meta', {}).get('next_cursor')
+    return results[:max_results]
+
+async def fetch_cited_by_papers(cited_by_url: str, max_results: int = 500, cursor: bool = False,
+                                fields: str = paper_fields) -> list[dict]:
+    """Fetch papers that cite the given paper.
+
+    The first page's meta.count tells how many pages are needed to reach
+    max_results; the remaining pages are then requested concurrently.
+    With cursor=True (or past the paging limit) the listing is walked
+    sequentially with cursor pagination instead.
+    """
+    if max_results <= 0:
+        return []
+    if snapshot_store is not None:
+        _, works = await asyncio.to_thread(
+            snapshot_store.citers, cited_work_from_url(cited_by_url), max_results, 0, fields
+        )
+        return prepare_papers(works)
+    per_page = min(200, max_results)  # OpenAlex max is 200
+    if cursor or max_results > OPENALEX_MAX_PAGED_RESULTS:
+        return await fetch_cited_by_cursor(cited_by_url, max_results, per_page, fields)
+
+    try:
+        first_page = await fetch_with_retry(cited_by_url, {"page": 1, "per-page": per_page, "select": fields})
+    except Exception as e:
+        app.logger.error(f"Error fetching cited_by papers: {str(e)}")
+        return []
+    if not first_page.get('results'):
+        return []
+
+    count = first_page.get('meta', {}).get('count') or len(first_page['results'])
+    pages = (min(count, max_results) + per_page - 1) // per_page
+    responses = await asyncio.gather(
+        *[fetch_with_retry(cited_by_url, {"page": page, "per-page": per_page, "select": fields})
+          for page in range(2, pages + 1)],
+        return_exceptions=True
+    )
 
-async def fetch_cited_by_papers(cited_by_url: str, max_results: int = 500) -> list[dict]:
-    """Fetch papers that cite the given paper"""
     results = []
-    page = 1
-    per_page = 200  # OpenAlex max
-    
-    async with aiohttp.ClientSession() as session:
-        while len(results) < max_results:
-            paginated_url = f"{cited_by_url}&page={page}&per-page={per_page}"
-            try:
-                async with session.get(paginated_url) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    
-                    if not data.get('results'):
-                        break
-                        
-                    for paper in data['results']:
-                        # Ensure topics is a list
-                        if 'topics' not in paper:
-                            paper['topics'] = []
-                            
-                        if "abstract_inverted_index" not in paper:
-                            paper["abstract"] = "MISSING_ABSTRACT"
-                        else:
-                            paper["abstract"] = reconstruct_abstract(paper["abstract_inverted_index"])
-                    
-                    results.extend(data['results'])
-                    
-                    if len(data['results']) < per_page:  # Last page
-                        break
-                        
-                    page += 1
-                    
-            except Exception as e:
-                app.logger.error(f"Error fetching cited_by papers: {str(e)}")
-                break
-                
-            await asyncio.sleep(0.1)  # Rate limiting
+    for data in [first_page, *responses]:
+        if isinstance(data, Exception):
+            app.logger.error(f"Error fetching cited_by papers: {str(data)}")
+            continue
+        if not data or not data.get('results'):
+            continue
+        works_cache.put_many_later(data['results'], cache_fields)
+        results.extend(prepare_papers(data['results']))
             
     return results[:max_results]
 
-async def fetch_citation_network(doi: str, max_papers: int) -> pd.DataFrame:
-    """Fetch citation network for a single paper"""
+async def fetch_citation_network(doi: str, max_papers: int, fields: str = paper_fields,
+                                 graph: Optional[CitationGraph] = None) -> list[dict]:
+    """Fetch citation network for a single paper (citations seen are added to graph, if given).
+
+    Works are deduplicated by OpenAlex ID as each page comes in, works
+    without a DOI included.
+    """
     app.logger.info(f"Starting fetch_citation_network for DOI: {doi}")
-    paper_data = {}
+    paper_data = []
+    deduper = WorkDeduper()
     
     try:
         # Get initial paper network info
         network_info = await get_paper_network_info(doi)
         if not network_info:
             raise ValueError(f"Could not fetch network info for paper: {doi}")
+        seed_id = network_info.get('id')
+        if graph is not None:
+            graph.add_seed(seed_id)
         
         # Get cited_by papers
         cited_by_url = network_info.get('cited_by_api_url')
         if cited_by_url:
             app.logger.info(f"Fetching cited_by papers for DOI: {doi}")
-            cited_by_papers = await fetch_cited_by_papers(cited_by_url, max_results=max_papers//2)
-            for paper in cited_by_papers:
-                if paper.get('doi'):
-                    paper_data[paper['doi']] = paper
+            cited_by_papers = await fetch_cited_by_papers(cited_by_url, max_results=max_papers//2, fields=fields)
+            if graph is not None:
+                graph.add_edges((paper.get('id'), seed_id) for paper in cited_by_papers)
+            paper_data.extend(deduper.filter(cited_by_papers))
         
         # Get referenced works
         referenced_works = network_info.get('referenced_works', [])
+        if graph is not None:
+            graph.add_edges((seed_id, work) for work in referenced_works)
         if referenced_works:
             app.logger.info(f"Fetching {len(referenced_works)} referenced works for DOI: {doi}")
-            # Process in batches of 50
-            batch_size = 50
-            for i in range(0, len(referenced_works), batch_size):
-                batch = referenced_works[i:i + batch_size]
-                referenced_papers = await fetch_papers_batch(batch)
-                for paper in referenced_papers:
-                    if paper.get('doi'):
-                        paper_data[paper['doi']] = paper
-                
-                if len(paper_data) >= max_papers:
-                    break
+            # Full-size batches sent concurrently, in waves no larger than what is
+            # still missing to reach max_papers
+            pending = list(referenced_works)
+            while pending and len(paper_data) < max_papers:
+                needed = max_papers - len(paper_data)
+                wave_size = -(-needed // OPENALEX_MAX_OR_VALUES) * OPENALEX_MAX_OR_VALUES
+                wave, pending = pending[:wave_size], pending[wave_size:]
+                batches = [wave[i:i + OPENALEX_MAX_OR_VALUES] for i in range(0, len(wave), OPENALEX_MAX_OR_VALUES)]
+                responses = await asyncio.gather(*[fetch_papers_batch(batch, fields) for batch in batches])
+                for referenced_papers in responses:
+                    for paper in referenced_papers:
+                        if len(paper_data) >= max_papers:
+                            break
+                        if deduper.add_paper(paper):
+                            paper_data.append(paper)
         
         if not paper_data:
             raise ValueError(f"No papers found in citation network for DOI: {doi}")
             
-        return pd.DataFrame(list(paper_data.values()))
+        return paper_data
         
     except Exception as e:
         app.logger.error(f"Error in fetch_citation_network for DOI {doi}: {str(e)}")
         raise
 
-async def fetch_all_citation_networks(dois: list[str], total_max_papers: int = 2000) -> pd.DataFrame:
-    """Fetch two layers of citation networks for multiple papers"""
+def cited_by_url(openalex_id: str) -> str:
+    return f"{BASE_OPENALEX}/works?filter=cites:{normalize_openalex_id(openalex_id)}"
+
+async def fetch_citers(openalex_id: str, max_results: int, fields: str = paper_fields) -> list[dict]:
+    """Works citing the given OpenAlex ID"""
+    return await fetch_cited_by_papers(cited_by_url(openalex_id), max_results=max_results, fields=fields)
+
+async def fetch_seed_networks(dois: list[str], total_max_papers: int = 2000, fields: str = paper_fields,
+                              graph: Optional[CitationGraph] = None) -> tuple[list[dict], Counter, WorkDeduper]:
+    """Layer 1 of fetch_all_citation_networks: the citation networks of the input DOIs, merged.
+
+    Returns the works, each kept once, how many of the seeds' networks each
+    work showed up in, and the deduper holding them for the crawl.
+    """
     papers_per_layer = total_max_papers // 2  # Split limit between layers
-    
+
+    # Full citation networks (cited_by + references) for input DOIs
+    papers_per_doi = max(1, papers_per_layer // len(dois))
+    tasks = [fetch_citation_network(doi, papers_per_doi, fields=fields, graph=graph) for doi in dois]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    layer1_results = []
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            app.logger.error(f"Failed to fetch network for DOI {dois[i]}: {str(result)}")
+        elif result:
+            layer1_results.append(result)
+
+    if not layer1_results:
+        raise Exception(f"Failed to fetch citation networks for all {len(dois)} DOIs")
+
+    # Seed proximity: in how many of the seeds' networks a paper shows up
+    proximity = Counter(
+        normalize_openalex_id(paper.get('id')) for paper in chain.from_iterable(layer1_results)
+    )
+    # Combine Layer 1 results, each work kept once; the crawl shares the same deduper
+    deduper = WorkDeduper()
+    layer1 = deduper.filter(chain.from_iterable(layer1_results))
+    return layer1, proximity, deduper
+
+async def crawl_citers(layer1: list[dict], proximity: Counter, deduper: WorkDeduper, total_max_papers: int = 2000,
+                       priority: str = "citations", workers: Optional[int] = None, fields: str = paper_fields,
+                       graph: Optional[CitationGraph] = None) -> list[dict]:
+    """Layer 2 of fetch_all_citation_networks: cited_by papers of the layer 1 works, within what is left of the budget"""
+    budget = max(0, total_max_papers - len(layer1))
+    crawler = CitationCrawler(
+        partial(fetch_citers, fields=fields),
+        budget=budget,
+        workers=workers or int(app.config["OPENALEX_CRAWL_WORKERS"]),
+        per_source=per_source_limit(budget, len(layer1)),
+        priority=priority,
+        deduper=deduper,
+    )
+    for paper in layer1:
+        work_id = normalize_openalex_id(paper.get('id'))
+        crawler.enqueue(paper, proximity=proximity.get(work_id, 1))
+    app.logger.info(f"Crawling cited_by papers of {len(crawler)} layer 1 papers, budget {budget}")
+    layer2_results = await crawler.run()
+    if graph is not None:
+        graph.add_edges(crawler.edges)
+    return layer2_results
+
+async def fetch_all_citation_networks(dois: list[str], total_max_papers: int = 2000, priority: str = "citations",
+                                      workers: Optional[int] = None, fields: str = paper_fields,
+                                      graph: Optional[CitationGraph] = None) -> pd.DataFrame:
+    """Fetch two layers of citation networks for multiple papers.
+
+    Layer 2 is a bounded crawl over the cited-by listings of the layer 1
+    papers, visited in priority order (see CitationCrawler) until the total
+    paper budget is used up. With a graph, every citation seen along the way
+    is recorded in it for rank_by_pagerank.
+    """
     try:
-        # Layer 1: Full citation networks (cited_by + references) for input DOIs
-        papers_per_doi = papers_per_layer // len(dois)
-        tasks = [fetch_citation_network(doi, papers_per_doi) for doi in dois]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Process Layer 1 results
-        layer1_results = []
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                app.logger.error(f"Failed to fetch network for DOI {dois[i]}: {str(result)}")
-            elif isinstance(result, pd.DataFrame) and not result.empty:
-                layer1_results.append(result)
-        
-        if not layer1_results:
-            raise Exception(f"Failed to fetch citation networks for all {len(dois)} DOIs")
-            
-        # Combine Layer 1 results and remove duplicates
-        layer1_df = pd.concat(layer1_results, ignore_index=True).drop_duplicates(subset=['doi'])
-        
-        # Layer 2: Fetch only cited_by papers for Layer 1 results
-        papers_per_source = papers_per_layer // len(layer1_df)
-        layer2_tasks = []
-        
-        for _, paper in layer1_df.iterrows():
-            if 'cited_by_api_url' in paper:
-                task = fetch_cited_by_papers(paper['cited_by_api_url'], max_results=papers_per_source)
-                layer2_tasks.append(task)
-        
-        if layer2_tasks:
-            layer2_results = await asyncio.gather(*layer2_tasks, return_exceptions=True)
-            valid_layer2_results = []
-            
-            for result in layer2_results:
-                if isinstance(result, list) and result:  # Skip exceptions and empty results
-                    valid_layer2_results.extend(result)
-            
-            if valid_layer2_results:
-                layer2_df = pd.DataFrame(valid_layer2_results).drop_duplicates(subset=['doi'])
-                # Combine both layers, removing duplicates
-                final_df = pd.concat([layer1_df, layer2_df], ignore_index=True).drop_duplicates(subset=['doi'])
-            else:
-                final_df = layer1_df
-        else:
-            final_df = layer1_df
+        layer1, proximity, deduper = await fetch_seed_networks(dois, total_max_papers, fields=fields, graph=graph)
+        layer2_results = await crawl_citers(
+            layer1, proximity, deduper, total_max_papers,
+            priority=priority, workers=workers, fields=fields, graph=graph
+        )
+        final_df = pd.DataFrame(layer1 + layer2_results)
         
         app.logger.info(f"Final combined DataFrame has {len(final_df)} papers")
         return final_df
@@ -298,58 +503,174 @@ async def fetch_all_citation_networks(dois: list[str], total_max_papers: int = 2
         app.logger.error(f"Error in fetch_all_citation_networks: {str(e)}")
         raise
 
-def reconstruct_abstract(index: dict) -> str:
-    """Reconstruct abstract from inverted index"""
-    if isinstance(index, type(None)):
+async def hydrate_papers(papers: pd.DataFrame, fields: str = paper_fields) -> pd.DataFrame:
+    """Fill in the full metadata of papers that were collected with ranking_fields.
+
+    Meant for the top-k after ranking: the works are fetched in concurrent
+    OpenAlex ID batches (through the works cache) and merged back row by row,
+    so the order and the ranking columns (score) are kept.
+    """
+    if papers.empty:
+        return papers
+    ids = [i for i in papers["id"].tolist() if isinstance(i, str)]
+    batches = [ids[i:i + OPENALEX_MAX_OR_VALUES] for i in range(0, len(ids), OPENALEX_MAX_OR_VALUES)]
+    responses = await asyncio.gather(*[fetch_papers_batch(batch, fields) for batch in batches], return_exceptions=True)
+
+    full = {}
+    for response in responses:
+        if isinstance(response, Exception):
+            app.logger.error(f"Error hydrating papers: {str(response)}")
+            continue
+        for paper in response:
+            full[normalize_openalex_id(paper.get("id"))] = paper
+
+    rows = [{**paper, **full.get(normalize_openalex_id(paper.get("id")), {})} for paper in papers.to_dict("records")]
+    app.logger.info(f"Hydrated {len(full)}/{len(papers)} papers")
+    return pd.DataFrame(rows, index=papers.index)
+
+class AbstractCache:
+    """Bounded LRU of reconstructed abstracts, keyed by OpenAlex work ID"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, work_id: Optional[str]) -> Optional[str]:
+        if not work_id:
+            return None
+        with self._lock:
+            abstract = self._entries.get(work_id)
+            if abstract is not None:
+                self._entries.move_to_end(work_id)
+            return abstract
+
+    def put(self, work_id: Optional[str], abstract: str):
+        if not work_id or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[work_id] = abstract
+            self._entries.move_to_end(work_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+abstract_cache = AbstractCache(int(app.config["ABSTRACT_CACHE_SIZE"]))
+
+def abstract_text(index: Optional[dict]) -> str:
+    """Abstract text from an OpenAlex inverted index (word -> positions)"""
+    if not isinstance(index, dict):
         return "MISSING_ABSTRACT"
-    
-    max_position_sum = sum([len(position)+1 for position in index.values()]) + 500 # + 500 for safety 
-    abstract_array = max_position_sum*[None]
-    for word, positions in index.items():
-        for position in positions:
-            abstract_array[position] = word
-    abstract_array = [i for i in abstract_array if i is not None]
-    abstract_string = ' '.join(abstract_array)
-    abstract_string = abstract_string.replace(r'^abstract\s+', '')
-    return abstract_string
+    # The last word listed at a position wins, as it did with the positional array
+    words = {position: word for word, positions in index.items() for position in positions}
+    return " ".join([words[position] for position in sorted(words)])
+
+def reconstruct_abstract(index: Optional[dict], work_id: Optional[str] = None) -> str:
+    """Reconstruct abstract from inverted index, memoized by OpenAlex work ID when given"""
+    work_id = normalize_openalex_id(work_id) if isinstance(work_id, str) else None
+    abstract = abstract_cache.get(work_id)
+    if abstract is None:
+        abstract = abstract_text(index)
+        if isinstance(index, dict):
+            abstract_cache.put(work_id, abstract)
+    return abstract
+
+def reconstruct_abstracts(indexes: list[Optional[dict]], work_ids: Optional[list[str]] = None) -> list[str]:
+    if work_ids is None:
+        return [abstract_text(index) for index in indexes]
+    return [reconstruct_abstract(index, work_id) for index, work_id in zip(indexes, work_ids)]
+
+def abstract_inputs(papers: pd.DataFrame) -> tuple[list[Optional[dict]], list[Optional[str]]]:
+    """Inverted indexes and work IDs of the papers, for reconstruct_abstracts"""
+    missing = pd.Series([None] * len(papers), index=papers.index, dtype=object)
+    return (papers.get("abstract_inverted_index", missing).tolist(), papers.get("id", missing).tolist())
+
+async def fetch_doi_batch(dois: list[str], fields: str = paper_fields) -> list[dict]:
+    """Fetch works for up to OPENALEX_MAX_OR_VALUES bare DOIs in one filter request"""
+    if not dois:
+        return []
+    params = {
+        "filter": "doi:" + "|".join(dois),
+        "select": fields,
+        "per-page": len(dois),
+    }
+    data = await fetch_with_retry(f"{BASE_OPENALEX}/works", params)
+    return data.get('results', []) if data else []
+
+async def fetch_single_doi(doi: str, fields: str = paper_fields) -> Optional[dict]:
+    """Fetch one work by DOI, None if OpenAlex does not know it"""
+    url = f"{BASE_OPENALEX}/works/https://doi.org/{doi}"
+    return await fetch_with_retry(url, {"select": fields}, not_found_ok=True)
+
+async def resolve_dois(dois: list[str], fields: str = paper_fields) -> tuple[list[dict], list[str]]:
+    """Resolve DOIs in bulk with filter=doi:a|b|c requests sent concurrently.
+
+    Returns the works found, in input order, and the input DOIs OpenAlex did
+    not know about.
+    """
+    if "doi" not in fields.split(","):
+        fields = f"{fields},doi"
+
+    # Keep the first spelling of every DOI so results map back to the input order
+    wanted = {}
+    for doi in dois:
+        clean_doi = normalize_doi(doi)
+        if clean_doi and clean_doi not in wanted:
+            wanted[clean_doi] = doi
+
+    if snapshot_store is not None:
+        works = await asyncio.to_thread(snapshot_store.get_works_by_doi, wanted, fields)
+        found = {normalize_doi(work.get("doi")): work for work in works}
+        return [found[d] for d in wanted if d in found], [wanted[d] for d in wanted if d not in found]
+
+    found = await works_cache.aget_many_by_doi(wanted, fields)
+    unresolved = [d for d in wanted if d not in found]
+
+    # Separators inside a DOI would break the OR filter, look those up one by one
+    batchable = [d for d in unresolved if "|" not in d and "," not in d]
+    singles = [d for d in unresolved if "|" in d or "," in d]
+    batches = [
+        batchable[i:i + OPENALEX_MAX_OR_VALUES]
+        for i in range(0, len(batchable), OPENALEX_MAX_OR_VALUES)
+    ]
+
+    tasks = [fetch_doi_batch(batch, fields) for batch in batches]
+    tasks += [fetch_single_doi(doi, fields) for doi in singles]
+    responses = await asyncio.gather(*tasks, return_exceptions=True)
+
+    failed = set()
+    for requested, response in zip(batches + [[d] for d in singles], responses):
+        if isinstance(response, Exception):
+            app.logger.error(f"Error fetching papers for DOIs {requested}: {str(response)}")
+            failed.update(requested)
+            continue
+        if isinstance(response, dict):
+            response = [response]
+        works_cache.put_many_later(response or [], cache_fields)
+        for paper in response or []:
+            clean_doi = normalize_doi(paper.get("doi"))
+            if clean_doi in wanted:
+                found[clean_doi] = paper
+
+    papers = [found[d] for d in wanted if d in found]
+    missing = [wanted[d] for d in wanted if d not in found and d not in failed]
+    return papers, missing
 
 async def get_papers_from_dois(dois: list[str]) -> pd.DataFrame:
     """Get paper metadata for a list of DOIs"""
-    paper_data = []
-    
-    async with aiohttp.ClientSession() as session:
-        for doi in dois:
-            base_doi = "https://doi.org"
-            clean_doi = doi.replace("https://doi.org/", "").replace("http://doi.org/", "")
-            doi_url = f"{base_doi}/{clean_doi}"
-            url = f"{BASE_OPENALEX}/works/{doi_url}?select={paper_fields}&mailto={OPENALEX_EMAIL}"
-            
-            try:
-                async with session.get(url) as response:
-                    if response.status == 404:
-                        app.logger.warning(f"DOI not found in OpenAlex: {doi_url}")
-                        continue
-                        
-                    response.raise_for_status()
-                    paper = await response.json()
-                    
-                    if "abstract_inverted_index" not in paper:
-                        paper["abstract"] = "MISSING_ABSTRACT"
-                    else:
-                        paper["abstract"] = reconstruct_abstract(paper["abstract_inverted_index"])
-                        
-                    paper_data.append(paper)
-                    
-            except Exception as e:
-                app.logger.error(f"Error fetching paper for DOI {doi}: {str(e)}")
-                continue
-                
-            await asyncio.sleep(0.1)  # Rate limiting
-    
-    if not paper_data:
+    papers, missing = await resolve_dois(dois)
+
+    for doi in missing:
+        app.logger.warning(f"DOI not found in OpenAlex: https://doi.org/{normalize_doi(doi)}")
+
+    if not papers:
         return pd.DataFrame()
-        
-    return pd.DataFrame(paper_data)
+
+    # Responses are shared read-only, the DataFrame holds its own copies
+    return pd.DataFrame([dict(paper) for paper in papers])
 
 def format_authors(authorships):
     if not authorships:  # Handle None or empty list
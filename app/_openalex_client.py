@@ -0,0 +1,235 @@
+import asyncio
+import atexit
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import aiohttp
+from app import app
+
+
+class TokenBucketLimiter:
+    """Token bucket that every OpenAlex request in the process acquires from.
+
+    Waiters are served in FIFO order. A 429 blocks the whole bucket until the
+    server's Retry-After has passed, so concurrent requests back off together
+    instead of each hammering the API with its own retries.
+    Only used from the OpenAlexClient event loop.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = None
+        # counters
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def reset_loop(self):
+        self._lock = None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        start = time.monotonic()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self._blocked_until:
+                        await asyncio.sleep(self._blocked_until - now)
+                        continue
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+        finally:
+            self.queue_depth -= 1
+        self.requests += 1
+        self.wait_seconds += time.monotonic() - start
+
+    def block_for(self, seconds: float):
+        """Hold back every caller for the given number of seconds (after a 429)"""
+        self.throttled += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenAlexClient:
+    """Long-lived HTTP client shared by every OpenAlex fetcher.
+
+    Flask runs each async view on its own short-lived event loop, so a session
+    created inside a view dies with the request. The client instead owns a
+    background event loop thread where a single keep-alive session lives for
+    the whole process; callers on any loop submit requests to it and await the
+    result.
+    """
+
+    def __init__(self, mailto: Optional[str] = None, max_connections: int = 100,
+                 max_connections_per_host: int = 20, dns_ttl: int = 300,
+                 keepalive_timeout: float = 30.0, timeout: float = 30.0,
+                 rate_limit: float = 10.0, rate_burst: int = 10):
+        self.mailto = mailto
+        self.limiter = TokenBucketLimiter(rate_limit, rate_burst)
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._inflight = {}
+        self.coalesced = 0
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        # Started lazily so that forked gunicorn workers each get their own thread
+        with self._lock:
+            if self._loop is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="openalex-client", daemon=True
+                )
+                self._thread.start()
+                self._session = None
+                self._inflight = {}
+                self.limiter.reset_loop()
+            return self._loop
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Only ever called on the client loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Accept-Encoding": "gzip, deflate", "Accept": "application/json"},
+                auto_decompress=True,
+            )
+        return self._session
+
+    def _with_mailto(self, params: Optional[dict]) -> dict:
+        params = dict(params or {})
+        if self.mailto and "mailto" not in params:
+            params["mailto"] = self.mailto
+        return params
+
+    async def _get_json(self, url: str, params: dict, not_found_ok: bool) -> Optional[dict]:
+        await self.limiter.acquire()
+        session = self._get_session()
+        async with session.get(url, params=params) as response:
+            if response.status == 404 and not_found_ok:
+                return None
+            if response.status == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is None:
+                    retry_after = random.uniform(0.5, 1.5)
+                self.limiter.block_for(retry_after)
+            response.raise_for_status()
+            return await response.json()
+
+    async def _get_json_single_flight(self, url: str, params: dict, not_found_ok: bool) -> Optional[dict]:
+        # Callers asking for a URL that is already being fetched await the same
+        # future instead of sending a duplicate request
+        key = (url, tuple(sorted((k, str(v)) for k, v in params.items())), not_found_ok)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._get_json(url, params, not_found_ok))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # One caller giving up must not cancel the request for the others
+        return await asyncio.shield(future)
+
+    async def get_json(self, url: str, params: Optional[dict] = None, not_found_ok: bool = False) -> Optional[dict]:
+        """GET an OpenAlex URL through the shared session and return the decoded JSON.
+
+        Identical concurrent requests are coalesced, so the returned object may
+        be shared with other callers and must be treated as read-only.
+        Returns None for a 404 when not_found_ok is set, otherwise raises
+        aiohttp.ClientResponseError for any non-2xx response.
+        """
+        loop = self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(
+            self._get_json_single_flight(url, self._with_mailto(params), not_found_ok), loop
+        )
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        """Rate limiter counters (requests, 429s, time spent waiting, queue depth) and coalesced requests"""
+        return {**self.limiter.stats(), "coalesced": self.coalesced, "in_flight": len(self._inflight)}
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            if self._session is not None and not self._session.closed:
+                future = asyncio.run_coroutine_threadsafe(self._session.close(), self._loop)
+                try:
+                    future.result(timeout=5)
+                except Exception as e:
+                    app.logger.warning(f"Error closing OpenAlex session: {str(e)}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = None
+            self._thread = None
+            self._session = None
+
+
+openalex_client = OpenAlexClient(
+    mailto=app.config["OPENALEX_EMAIL"],
+    max_connections=int(app.config["OPENALEX_MAX_CONNECTIONS"]),
+    max_connections_per_host=int(app.config["OPENALEX_MAX_CONNECTIONS_PER_HOST"]),
+    dns_ttl=int(app.config["OPENALEX_DNS_TTL"]),
+    timeout=float(app.config["OPENALEX_TIMEOUT"]),
+    rate_limit=float(app.config["OPENALEX_RATE_LIMIT"]),
+    rate_burst=int(app.config["OPENALEX_RATE_BURST"]),
+)
+atexit.register(openalex_client.close)
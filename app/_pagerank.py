@@ -0,0 +1,117 @@
+from typing import Iterable, List, Optional
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from app import app
+from app._dedup import doi_mask, first_occurrences
+from app._identifiers import normalize_openalex_id
+from app._topicmod import top_ranked
+
+
+class CitationGraph:
+    """Citation edges (citing -> cited, by OpenAlex ID) collected while fetching a network.
+
+    Works are numbered as they are first seen; seeds are the works of the
+    input DOIs, where the personalized PageRank restarts.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.seeds = set()
+        self._citing = []
+        self._cited = []
+
+    def node(self, openalex_id: str) -> Optional[int]:
+        work_id = normalize_openalex_id(openalex_id)
+        if not work_id:
+            return None
+        return self.index.setdefault(work_id, len(self.index))
+
+    def add_edge(self, citing: str, cited: str):
+        i, j = self.node(citing), self.node(cited)
+        if i is not None and j is not None and i != j:
+            self._citing.append(i)
+            self._cited.append(j)
+
+    def add_edges(self, edges: Iterable[tuple[str, str]]):
+        for citing, cited in edges:
+            self.add_edge(citing, cited)
+
+    def add_seed(self, openalex_id: str):
+        if self.node(openalex_id) is not None:
+            self.seeds.add(normalize_openalex_id(openalex_id))
+
+    def adjacency(self, directed: bool = False) -> sparse.csr_matrix:
+        """n x n adjacency matrix, repeated edges collapsed; symmetric unless directed"""
+        n = len(self.index)
+        rows, cols = np.array(self._citing, dtype=np.int64), np.array(self._cited, dtype=np.int64)
+        if not directed:
+            rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        adjacency = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+        adjacency.data[:] = 1.0
+        return adjacency
+
+    def seed_nodes(self) -> np.ndarray:
+        return np.fromiter((self.index[seed] for seed in self.seeds), dtype=np.int64, count=len(self.seeds))
+
+    def __len__(self):
+        return len(self._citing)
+
+
+def personalized_pagerank(adjacency: sparse.csr_matrix, seeds: Iterable[int], damping: float = 0.85,
+                          tol: float = 1e-10, max_iter: int = 100) -> np.ndarray:
+    """Personalized PageRank by power iteration on a sparse adjacency matrix.
+
+    The walk follows the rows of adjacency and restarts uniformly at the
+    seeds with probability 1 - damping; nodes without out-links send their
+    mass back to the seeds as well. Works on plain arrays only, so it can run
+    in a worker process (see _executor.py).
+    """
+    n = adjacency.shape[0]
+    seeds = np.fromiter(seeds, dtype=np.int64)
+    if n == 0:
+        return np.zeros(0)
+    restart = np.zeros(n)
+    if len(seeds):
+        restart[seeds] = 1.0 / len(seeds)
+    else:
+        restart[:] = 1.0 / n
+    out_degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = out_degree == 0
+    inverse_degree = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+    transposed = adjacency.T.tocsr()
+
+    ranks = restart.copy()
+    for iteration in range(max_iter):
+        spread = transposed @ (ranks * inverse_degree)
+        updated = damping * spread + (damping * ranks[dangling].sum() + 1 - damping) * restart
+        delta = np.abs(updated - ranks).sum()
+        ranks = updated
+        if delta < tol:
+            break
+    return ranks
+
+
+def candidate_pagerank(results: pd.DataFrame, graph: CitationGraph, scores: np.ndarray,
+                       exclude_dois: List[str] = None) -> tuple[np.ndarray, np.ndarray]:
+    """Positions of the candidates to rank and their PageRank (0 for works outside the graph)"""
+    # Drop duplicates, input DOIs and the seed works themselves
+    ids = results["id"].map(normalize_openalex_id)
+    keep = first_occurrences(results) & ~ids.isin(graph.seeds).to_numpy()
+    if exclude_dois:
+        keep &= ~doi_mask(results, exclude_dois)
+    rows = np.flatnonzero(keep)
+    nodes = ids.iloc[rows].map(graph.index).fillna(-1).astype(np.int64).to_numpy()
+    candidate_scores = np.zeros(len(rows))
+    in_graph = nodes >= 0
+    candidate_scores[in_graph] = scores[nodes[in_graph]]
+    app.logger.info(f"PageRank over {len(graph.index)} works and {len(graph)} citations from {len(graph.seeds)} seeds")
+    return rows, candidate_scores
+
+
+def rank_by_pagerank(results: pd.DataFrame, graph: CitationGraph, top_k=20, exclude_dois: List[str] = None,
+                     damping: float = 0.85) -> pd.DataFrame:
+    """Rank candidates by personalized PageRank from the seeds, highest first"""
+    scores = personalized_pagerank(graph.adjacency(), graph.seed_nodes(), damping=damping)
+    rows, candidate_scores = candidate_pagerank(results, graph, scores, exclude_dois)
+    return top_ranked(results, rows, candidate_scores, top_k, descending=True)
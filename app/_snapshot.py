@@ -0,0 +1,239 @@
+import glob
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Iterable, Optional
+import click
+from app import app
+from app._identifiers import normalize_doi, normalize_openalex_id
+
+OPENALEX_WORK_URL = "https://openalex.org/W"
+# Metadata kept per work, besides the ID, DOI, abstract and references that get their own columns
+RECORD_FIELDS = ("title", "authorships", "publication_year", "primary_location", "topics", "cited_by_count")
+
+
+def work_number(openalex_id: Optional[str]) -> Optional[int]:
+    """Numeric part of an OpenAlex work ID (W123 -> 123), used as the row key"""
+    work_id = normalize_openalex_id(openalex_id)
+    if not work_id or not work_id.startswith("W") or not work_id[1:].isdigit():
+        return None
+    return int(work_id[1:])
+
+
+def _compress(value) -> Optional[bytes]:
+    if value is None:
+        return None
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)
+
+
+def _decompress(blob: Optional[bytes]):
+    if blob is None:
+        return None
+    return json.loads(zlib.decompress(blob))
+
+
+class SnapshotStore:
+    """Local, indexed copy of an OpenAlex works snapshot.
+
+    One SQLite file holds the work records (compressed metadata and
+    abstracts, DOI index), the references adjacency list with a reverse
+    cited-by index, and an FTS5 full-text index over titles and abstracts.
+    The query methods return records shaped like OpenAlex API responses so
+    the fetchers in _openalex.py can answer from it unchanged.
+    """
+
+    def __init__(self, path: str, api_base: str = "https://api.openalex.org"):
+        self.path = path
+        self.api_base = api_base
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread; reads run in asyncio.to_thread workers
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS works (
+                    id INTEGER PRIMARY KEY,
+                    doi TEXT,
+                    cited_by_count INTEGER NOT NULL DEFAULT 0,
+                    record BLOB NOT NULL,
+                    abstract BLOB
+                );
+                CREATE INDEX IF NOT EXISTS works_doi ON works(doi);
+                CREATE TABLE IF NOT EXISTS refs (
+                    citing INTEGER NOT NULL,
+                    cited INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS refs_citing ON refs(citing);
+                CREATE INDEX IF NOT EXISTS refs_cited ON refs(cited);
+                CREATE VIRTUAL TABLE IF NOT EXISTS works_fts USING fts5(title, abstract);
+                """
+            )
+            self._local.conn = conn
+        return conn
+
+    # Ingestion
+
+    def ingest_work(self, conn: sqlite3.Connection, work: dict, fulltext: bool = True) -> bool:
+        from app._openalex import abstract_text  # _openalex imports this module
+        number = work_number(work.get("id"))
+        if number is None:
+            return False
+        index = work.get("abstract_inverted_index")
+        record = {field: work.get(field) for field in RECORD_FIELDS}
+        conn.execute(
+            "INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?, ?)",
+            (number, normalize_doi(work.get("doi")), work.get("cited_by_count") or 0,
+             _compress(record), _compress(index)),
+        )
+        # Partitions are ingested oldest first, a newer version of a work replaces its references
+        conn.execute("DELETE FROM refs WHERE citing = ?", (number,))
+        conn.executemany(
+            "INSERT INTO refs VALUES (?, ?)",
+            [(number, cited) for cited in map(work_number, work.get("referenced_works") or []) if cited],
+        )
+        if fulltext:
+            conn.execute("DELETE FROM works_fts WHERE rowid = ?", (number,))
+            conn.execute(
+                "INSERT INTO works_fts (rowid, title, abstract) VALUES (?, ?, ?)",
+                (number, work.get("title") or "", abstract_text(index) if index else ""),
+            )
+        return True
+
+    def ingest(self, paths: Iterable[str], fulltext: bool = True, commit_every: int = 10000) -> int:
+        """Load gzip JSONL snapshot partitions, returns the number of works ingested"""
+        conn = self._connect()
+        count = 0
+        for path in paths:
+            app.logger.info(f"Ingesting snapshot partition {path}")
+            with gzip.open(path, "rt", encoding="utf-8") as partition:
+                for line in partition:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if self.ingest_work(conn, json.loads(line), fulltext=fulltext):
+                        count += 1
+                        if count % commit_every == 0:
+                            conn.commit()
+            conn.commit()
+        return count
+
+    # Queries
+
+    def _cited_by_api_url(self, number: int) -> str:
+        return f"{self.api_base}/works?filter=cites:W{number}"
+
+    def _to_works(self, conn: sqlite3.Connection, rows: list[tuple], fields: Optional[str]) -> list[tuple[int, dict]]:
+        wanted = set(fields.split(",")) if fields else None
+        works = []
+        for number, doi, record, abstract in rows:
+            work = {"id": f"{OPENALEX_WORK_URL}{number}", "doi": f"https://doi.org/{doi}" if doi else None}
+            work.update(_decompress(record))
+            if wanted is None or "abstract_inverted_index" in wanted:
+                work["abstract_inverted_index"] = _decompress(abstract)
+            if wanted is None or "referenced_works" in wanted:
+                work["referenced_works"] = [
+                    f"{OPENALEX_WORK_URL}{cited}"
+                    for (cited,) in conn.execute("SELECT cited FROM refs WHERE citing = ?", (number,))
+                ]
+            work["cited_by_api_url"] = self._cited_by_api_url(number)
+            if wanted is not None:
+                work = {k: v for k, v in work.items() if k in wanted}
+            works.append((number, work))
+        return works
+
+    def _select(self, conn, where: str, args: list, fields: Optional[str], suffix: str = "") -> list[tuple[int, dict]]:
+        with_abstract = not fields or "abstract_inverted_index" in fields.split(",")
+        columns = "id, doi, record, " + ("abstract" if with_abstract else "NULL")
+        rows = conn.execute(f"SELECT {columns} FROM works WHERE {where} {suffix}", args).fetchall()
+        return self._to_works(conn, rows, fields)
+
+    def get_works(self, openalex_ids: Iterable[str], fields: Optional[str] = None) -> list[dict]:
+        """Works for the given IDs, in input order"""
+        numbers = list(dict.fromkeys(filter(None, map(work_number, openalex_ids))))
+        conn = self._connect()
+        found = {}
+        for i in range(0, len(numbers), 500):
+            chunk = numbers[i:i + 500]
+            found.update(self._select(conn, f"id IN ({','.join('?' * len(chunk))})", chunk, fields))
+        return [found[n] for n in numbers if n in found]
+
+    def get_works_by_doi(self, dois: Iterable[str], fields: Optional[str] = None) -> list[dict]:
+        clean_dois = list(dict.fromkeys(filter(None, map(normalize_doi, dois))))
+        conn = self._connect()
+        works = []
+        for i in range(0, len(clean_dois), 500):
+            chunk = clean_dois[i:i + 500]
+            works.extend(work for _, work in self._select(conn, f"doi IN ({','.join('?' * len(chunk))})", chunk, fields))
+        return works
+
+    def citers(self, openalex_id: str, limit: int, offset: int = 0, fields: Optional[str] = None) -> tuple[int, list[dict]]:
+        """Total number of citing works and one page of them, most cited first"""
+        number = work_number(openalex_id)
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM refs WHERE cited = ?", (number,)).fetchone()[0]
+        if not count:
+            return 0, []
+        works = self._select(
+            conn, "id IN (SELECT citing FROM refs WHERE cited = ?)", [number, limit, offset], fields,
+            suffix="ORDER BY cited_by_count DESC, id LIMIT ? OFFSET ?",
+        )
+        return count, [work for _, work in works]
+
+    def iter_records(self):
+        """Metadata of every work in the store (without abstract and references)"""
+        for (record,) in self._connect().execute("SELECT record FROM works"):
+            yield _decompress(record)
+
+    def search(self, query: str, limit: int, offset: int = 0, fields: Optional[str] = None) -> list[dict]:
+        """Full-text search over titles and abstracts, best BM25 match first"""
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        conn = self._connect()
+        numbers = [
+            number for (number,) in conn.execute(
+                "SELECT rowid FROM works_fts WHERE works_fts MATCH ? ORDER BY bm25(works_fts) LIMIT ? OFFSET ?",
+                (match, limit, offset),
+            )
+        ]
+        return self.get_works([f"W{n}" for n in numbers], fields)
+
+
+def cited_work_from_url(cited_by_url: str) -> Optional[str]:
+    """OpenAlex ID in a cited_by_api_url (...filter=cites:W123)"""
+    match = re.search(r"cites:(W\d+)", cited_by_url, flags=re.IGNORECASE)
+    return match.group(1).upper() if match else None
+
+
+SNAPSHOT_PATH = app.config["OPENALEX_SNAPSHOT_PATH"] or os.path.join(app.instance_path, "openalex_snapshot.sqlite")
+
+snapshot_store = None
+if app.config["OPENALEX_BACKEND"] == "snapshot":
+    snapshot_store = SnapshotStore(SNAPSHOT_PATH)
+    app.logger.info(f"Answering OpenAlex queries from the local snapshot {snapshot_store.path}")
+
+
+@app.cli.command("ingest-snapshot")
+@click.argument("snapshot_dir")
+@click.option("--db", default=None, help="Store path, defaults to OPENALEX_SNAPSHOT_PATH")
+@click.option("--no-fulltext", is_flag=True, help="Skip the full-text index (search will return nothing)")
+def ingest_snapshot(snapshot_dir, db, no_fulltext):
+    """Load an OpenAlex works snapshot (gzip JSONL partitions) into the local store."""
+    paths = sorted(glob.glob(os.path.join(snapshot_dir, "**", "*.gz"), recursive=True))
+    if not paths:
+        raise click.ClickException(f"No .gz partitions found under {snapshot_dir}")
+    store = SnapshotStore(db or SNAPSHOT_PATH)
+    start = time.time()
+    count = store.ingest(paths, fulltext=not no_fulltext)
+    click.echo(f"Ingested {count} works from {len(paths)} partitions in {time.time() - start:.0f}s into {store.path}")
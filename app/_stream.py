@@ -0,0 +1,50 @@
+import asyncio
+from typing import AsyncIterator, Iterator
+from flask import Response, stream_with_context
+from app import app
+
+STREAM_FORMATS = ("ndjson", "sse")
+
+
+def iterate_async(events: AsyncIterator) -> Iterator:
+    """Consume an async generator from sync code, on an event loop of its own.
+
+    Flask streams a response by iterating a plain generator after the view
+    has returned, outside any event loop. Each item is awaited on a private
+    loop; when the stream ends or the client goes away, the async generator
+    is closed and whatever it left running is cancelled.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(events.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        try:
+            loop.run_until_complete(events.aclose())
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+def encode_event(event: dict, stream_format: str) -> str:
+    """One event as an NDJSON line or a server-sent event named after its "event" field"""
+    data = app.json.dumps(event)
+    if stream_format == "sse":
+        return f"event: {event.get('event', 'message')}\ndata: {data}\n\n"
+    return f"{data}\n"
+
+
+def stream_response(events: AsyncIterator[dict], stream_format: str) -> Response:
+    """Streaming response of the events produced by an async generator"""
+    body = stream_with_context(encode_event(event, stream_format) for event in iterate_async(events))
+    mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+    # Proxies must pass every event through as soon as it is written
+    return Response(body, mimetype=mimetype, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
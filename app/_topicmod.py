@@ -1,65 +1,324 @@
-import os
-from typing import List, Tuple, Optional
-import aiohttp
-import asyncio
+from typing import Callable, List, Tuple, Optional
 import pandas as pd 
 import numpy as np 
-from itertools import combinations
+from scipy import sparse
 from app import app
-import time
+from app._dedup import WorkDeduper, doi_mask, first_occurrences
+from app._identifiers import normalize_doi
+import threading
 
 
 
+NPMI_SOURCES = ("request", "prior", "blend")
+
+class TopicVocabulary:
+    """Process-wide interning of OpenAlex topic IDs into dense integers.
+
+    Fetchers encode each work's topics into an int32 array of vocabulary
+    indices as responses arrive, so the ranking never walks the nested topic
+    dicts again. Indices are stable for the lifetime of the process.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def intern(self, topic_id: str) -> int:
+        index = self._index.get(topic_id)
+        if index is None:
+            with self._lock:
+                index = self._index.get(topic_id)
+                if index is None:
+                    index = len(self._ids)
+                    self._ids.append(topic_id)
+                    self._index[topic_id] = index
+        return index
+
+    def encode(self, topics) -> np.ndarray:
+        """int32 vocabulary indices of a work's topics (OpenAlex topic dicts)"""
+        if not isinstance(topics, list):
+            return np.empty(0, dtype=np.int32)
+        return np.fromiter((self.intern(t["id"]) for t in topics), dtype=np.int32, count=len(topics))
+
+    def decode(self, indices) -> List[str]:
+        return [self._ids[i] for i in indices]
+
+    def __len__(self):
+        return len(self._ids)
+
+topic_vocabulary = TopicVocabulary()
+
+def topic_csr(results: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR-style (offsets, indices) of the works' topics in vocabulary indices.
+
+    Uses the topic_ids the fetchers attach; frames that still carry the
+    topic dicts are encoded on the fly.
+    """
+    if "topic_ids" in results:
+        encoded = [
+            ids if isinstance(ids, np.ndarray) else np.empty(0, dtype=np.int32)
+            for ids in results["topic_ids"]
+        ]
+    else:
+        encoded = [topic_vocabulary.encode(topics) for topics in results["topics"]]
+    return stack_csr(encoded)
+
+def stack_csr(encoded: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in encoded], out=offsets[1:])
+    indices = np.concatenate(encoded) if encoded else np.empty(0, dtype=np.int32)
+    return offsets, indices.astype(np.int32, copy=False)
+
 def get_topics_set(results: pd.DataFrame):
-    topics = results["topics"]
-    topic_ids = []
-    for topic in topics:
-        for t in topic: 
-            topic_ids.append(t["id"])
-    return set(topic_ids)
+    _, indices = topic_csr(results)
+    return set(topic_vocabulary.decode(np.unique(indices)))
 
 def topic_idx_association(topics: set) -> List[dict]: 
     idx_t = {t:i for i,t in enumerate(topics)}
     # t_idx = {i:t for t,i in idx_t.items()}
     return idx_t #, t_idx
 
-def get_npmimatrix(results: pd.DataFrame, return_idx=True) -> np.ndarray:
-    topics = get_topics_set(results)
-    idx_t = topic_idx_association(topics)
-    # create a matrix to index through topics 
-    mutualmatrix = np.zeros([len(topics), len(topics)])
-    for _, res in results.iterrows():
-        # get p(x)
-        for t in res["topics"]:
-            id = idx_t[t["id"]]
-            mutualmatrix[id, id] = mutualmatrix[id, id] + 1
-        # get p(x,y)
-        for ti, tj in combinations(res["topics"], r=2):
-            idi, idj = idx_t[ti["id"]], idx_t[tj["id"]]
-            mutualmatrix[idi, idj] = mutualmatrix[idi, idj] + 1
-            mutualmatrix[idj, idi] = mutualmatrix[idj, idi] + 1
-    probmatrix = mutualmatrix / len(mutualmatrix)
-    npmimatrix = np.zeros_like(probmatrix)
-    for i,j in combinations(range(probmatrix.shape[0]), r=2):
-        if probmatrix[i,j] > 0:
-            npmimatrix[i,j] = np.log2(probmatrix[i,j]/(probmatrix[i,i]*probmatrix[j,j]))/(-np.log2(probmatrix[i,j]))
-            npmimatrix[j,i] = npmimatrix[i,j]
+def npmi_from_counts(mutualmatrix: sparse.spmatrix, n_topics: int) -> sparse.csr_matrix:
+    """Symmetric sparse NPMI matrix from topic counts (diagonal) and co-occurrences.
+
+    Probabilities are normalized by n_topics, the number of distinct topics
+    among the candidates, and the NPMI is evaluated over the non-zero
+    off-diagonal entries only.
+    """
+    # p(x) on the diagonal, p(x,y) off it
+    probmatrix = (mutualmatrix / max(n_topics, 1)).tocoo()
+    diagonal = probmatrix.diagonal()
+
+    off_diagonal = probmatrix.row != probmatrix.col
+    i, j = probmatrix.row[off_diagonal], probmatrix.col[off_diagonal]
+    p_ij = probmatrix.data[off_diagonal]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        npmi = np.log2(p_ij / (diagonal[i] * diagonal[j])) / (-np.log2(p_ij))
+    return sparse.csr_matrix((npmi, (i, j)), shape=probmatrix.shape)
+
+def npmi_from_incidence(incidence: sparse.csr_matrix) -> sparse.csr_matrix:
+    """NPMI matrix of a works x topics incidence matrix, counts taken at once as the sparse product X^T X"""
+    return npmi_from_counts(incidence.T @ incidence, incidence.shape[1])
+
+def local_topics(offsets: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray, sparse.csr_matrix]:
+    """Remap vocabulary indices to 0..T-1 over the topics present in the results.
+
+    Returns the vocabulary indices of the T topics, the remapped indices and
+    the works x topics incidence matrix (repeated topics are summed).
+    """
+    vocabulary, local = np.unique(indices, return_inverse=True)
+    local = local.astype(np.int32)
+    # The matrix gets its own copies: sum_duplicates sorts its indices in place
+    incidence = sparse.csr_matrix(
+        (np.ones(len(local)), local.copy(), offsets.copy()), shape=(len(offsets) - 1, len(vocabulary))
+    )
+    incidence.sum_duplicates()
+    return vocabulary, local, incidence
+
+def get_npmimatrix(results: pd.DataFrame, return_idx=True) -> sparse.csr_matrix:
+    """Symmetric sparse NPMI matrix between the topics of the results"""
+    offsets, indices = topic_csr(results)
+    vocabulary, _, incidence = local_topics(offsets, indices)
+    npmimatrix = npmi_from_incidence(incidence)
     if return_idx: 
+        idx_t = {topic: i for i, topic in enumerate(topic_vocabulary.decode(vocabulary))}
         return npmimatrix, idx_t
     else: 
         return npmimatrix
 
-def rank_results(results: pd.DataFrame, top_k=20, exclude_dois: List[str] = None) -> pd.DataFrame: 
-    npmimatrix, idx_t = get_npmimatrix(results, return_idx=True)
-    results["score"] = 0.0
-    for i, work in results.iterrows():
-        topics = work["topics"]
-        for ti, tj in combinations(topics, r=2):
-            results.loc[i, "score"] += npmimatrix[idx_t[ti["id"]], idx_t[tj["id"]]]
-    # Drop duplicates and exclude input DOIs
-    results = results.drop_duplicates(subset=['doi'])
+def matrix_lookup(npmimatrix: sparse.csr_matrix) -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+    """Pair lookup into a (per-request) NPMI matrix"""
+    return lambda a, b: np.asarray(npmimatrix[a, b]).ravel()
+
+def pair_scores(lookup: Callable[[np.ndarray, np.ndarray], np.ndarray], offsets: np.ndarray,
+                indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Sum of the NPMI over every pair of topics of each of the given works.
+
+    Works are grouped by their number of topics so that each group is a
+    dense (works x topics) slice of the CSR indices and all of its pairs are
+    gathered with a single lookup(a, b) call.
+    """
+    scores = np.zeros(len(rows))
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    for n in np.unique(lengths):
+        if n < 2:
+            continue
+        members = np.flatnonzero(lengths == n)
+        group = indices[starts[members, None] + np.arange(n)]
+        a, b = np.triu_indices(n, k=1)
+        values = lookup(group[:, a].ravel(), group[:, b].ravel()).reshape(len(members), len(a))
+        # Accumulate pair by pair, in the order the topics are listed, so
+        # scores (and ties) come out bit-identical whatever the group size
+        total = np.zeros(len(members))
+        for column in values.T:
+            total += column
+        scores[members] = total
+    return scores
+
+def select_top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Positions of the top_k lowest scores, in ascending score order (ties keep input order)"""
+    if top_k <= 0:
+        return np.array([], dtype=np.int64)
+    if top_k < len(scores):
+        # Partial selection of the k-th score, then everything below it plus
+        # the earliest works tied with it
+        kth = np.partition(scores, top_k - 1)[top_k - 1]
+        below = np.flatnonzero(scores < kth)
+        tied = np.flatnonzero(np.isnan(scores) if np.isnan(kth) else scores == kth)
+        candidates = np.concatenate([below, tied[:top_k - len(below)]])
+        candidates.sort()
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(scores[candidates], kind="stable")]
+
+def blend_scores(npmi_source: str, request_scores: Optional[np.ndarray], prior_scores: Optional[np.ndarray],
+                 prior_weight: float) -> np.ndarray:
+    if npmi_source == "request":
+        return request_scores
+    if npmi_source == "prior":
+        return prior_scores
+    return (1 - prior_weight) * request_scores + prior_weight * prior_scores
+
+def resolve_npmi_source(npmi_source: str, prior) -> str:
+    if npmi_source not in NPMI_SOURCES:
+        raise ValueError(f"Unknown NPMI source: {npmi_source}")
+    if npmi_source != "request" and prior is None:
+        app.logger.warning(f"No NPMI prior loaded, ranking with npmi_source=request instead of {npmi_source}")
+        return "request"
+    return npmi_source
+
+def candidate_rows(results: pd.DataFrame, exclude_dois: List[str] = None) -> np.ndarray:
+    """Positions of the works to score: first occurrence of each work, input DOIs left out"""
+    keep = first_occurrences(results)
     if exclude_dois:
-        results = results[~results['doi'].isin(exclude_dois)]
-    results = results.sort_values(by="score", ascending=True)
-    return results[:top_k]
+        keep &= ~doi_mask(results, exclude_dois)
+    return np.flatnonzero(keep)
+
+def request_pair_scores(offsets: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Pair scores of the given rows with NPMI statistics built from every work in (offsets, indices).
+
+    Works on plain int arrays only, so it can run in a worker process (see _executor.py).
+    """
+    _, local, incidence = local_topics(offsets, indices)
+    return pair_scores(matrix_lookup(npmi_from_incidence(incidence)), offsets, local, rows)
+
+def top_ranked(results: pd.DataFrame, rows: np.ndarray, scores: np.ndarray, top_k: int,
+               descending: bool = False) -> pd.DataFrame:
+    top = select_top_k(-scores if descending else scores, top_k)
+    ranked = results.iloc[rows[top]].copy()
+    ranked["score"] = scores[top]
+    return ranked
+
+def rank_results(results: pd.DataFrame, top_k=20, exclude_dois: List[str] = None, npmi_source: str = "request",
+                 prior=None, prior_weight: float = 0.5) -> pd.DataFrame: 
+    """Score candidates by the NPMI of their topic pairs and keep the top_k.
+
+    npmi_source picks the NPMI statistics: "request" builds them from the
+    candidates themselves, "prior" looks pairs up in the corpus-level prior
+    (an NpmiPrior, see _npmi_prior.py) and "blend" mixes both, weighting the
+    prior by prior_weight.
+    """
+    npmi_source = resolve_npmi_source(npmi_source, prior)
+    offsets, indices = topic_csr(results)
+    # Drop duplicates and exclude input DOIs before scoring anything
+    rows = candidate_rows(results, exclude_dois)
+    request_scores = prior_scores = None
+    if npmi_source in ("request", "blend"):
+        # The per-request statistics come from every candidate, duplicates included
+        request_scores = request_pair_scores(offsets, indices, rows)
+    if npmi_source in ("prior", "blend"):
+        prior_scores = pair_scores(prior.lookup, offsets, indices, rows)
+    scores = blend_scores(npmi_source, request_scores, prior_scores, prior_weight)
+    return top_ranked(results, rows, scores, top_k)
+
+def papers_csr(papers: List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR-style (offsets, indices) of the topic_ids of a list of papers"""
+    return stack_csr([
+        paper["topic_ids"] if isinstance(paper.get("topic_ids"), np.ndarray) else topic_vocabulary.encode(paper.get("topics"))
+        for paper in papers
+    ])
+
+class IncrementalRanker:
+    """rank_results for candidates that arrive page by page.
+
+    Every page updates running topic counts and co-occurrences (kept over the
+    whole topic vocabulary, duplicates included, like rank_results). The new
+    candidates and the ones kept so far are then scored against the
+    statistics seen so far, and only the oversample * top_k lowest scores are
+    kept; the others are dropped on the spot. result() rescores the kept
+    candidates with the final statistics and returns the top_k, so memory
+    stays proportional to k and the topic vocabulary rather than to the
+    candidate set. A candidate dropped early cannot come back, so the result
+    is exact only when the kept pool can hold every candidate.
+    """
+
+    def __init__(self, top_k: int = 20, exclude_dois: List[str] = None, oversample: int = 10,
+                 npmi_source: str = "request", prior=None, prior_weight: float = 0.5):
+        npmi_source = resolve_npmi_source(npmi_source, prior)
+        self.top_k = top_k
+        self.capacity = max(top_k * oversample, top_k)
+        self.exclude_dois = set(filter(None, map(normalize_doi, exclude_dois or [])))
+        self.npmi_source = npmi_source
+        self.prior = prior
+        self.prior_weight = prior_weight
+        self.counts = sparse.csr_matrix((0, 0))
+        self.seen_dois = {}  # every DOI seen, in arrival order
+        self.deduper = WorkDeduper()
+        self.candidates = 0
+        self._kept = []  # the capacity best candidates so far, in arrival order
+
+    def _scores(self, offsets: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        request_scores = prior_scores = None
+        if self.npmi_source in ("request", "blend"):
+            n_topics = int(np.count_nonzero(self.counts.diagonal()))
+            npmimatrix = npmi_from_counts(self.counts, n_topics)
+            request_scores = pair_scores(matrix_lookup(npmimatrix), offsets, indices, rows)
+        if self.npmi_source in ("prior", "blend"):
+            prior_scores = pair_scores(self.prior.lookup, offsets, indices, rows)
+        return blend_scores(self.npmi_source, request_scores, prior_scores, self.prior_weight)
+
+    def add(self, papers: List[dict]):
+        """Feed one page of candidates (papers carrying topic_ids)"""
+        if not papers:
+            return
+        offsets, indices = papers_csr(papers)
+        size = len(topic_vocabulary)
+        incidence = sparse.csr_matrix(
+            (np.ones(len(indices)), indices.copy(), offsets.copy()), shape=(len(papers), size)
+        )
+        self.counts.resize((size, size))
+        self.counts = (self.counts + incidence.T @ incidence).tocsr()
+
+        # First occurrence of each work only, input DOIs left out
+        rows = []
+        for row, paper in enumerate(papers):
+            if not self.deduper.add_paper(paper):
+                continue
+            doi = paper.get("doi")
+            if doi:
+                self.seen_dois[doi] = None
+            if normalize_doi(doi) not in self.exclude_dois:
+                rows.append(row)
+        self.candidates += len(rows)
+        if not rows:
+            return
+        # The statistics moved with this page: rescore what is kept along with the newcomers
+        pool = self._kept + [papers[row] for row in rows]
+        pool_offsets, pool_indices = papers_csr(pool)
+        scores = self._scores(pool_offsets, pool_indices, np.arange(len(pool)))
+        keep = np.sort(select_top_k(scores, self.capacity))  # arrival order
+        self._kept = [pool[i] for i in keep]
 
+    def result(self) -> pd.DataFrame:
+        """Top-k of everything added so far, rescored with the final statistics"""
+        papers = self._kept
+        if not papers:
+            return pd.DataFrame()
+        offsets, indices = papers_csr(papers)
+        scores = self._scores(offsets, indices, np.arange(len(papers)))
+        top = select_top_k(scores, self.top_k)
+        ranked = pd.DataFrame([papers[i] for i in top])
+        ranked["score"] = scores[top]
+        return ranked
@@ -1,15 +1,37 @@
+import asyncio
+import hashlib
+import json
 import os
+import threading
+import time
 import traceback
 from datetime import datetime
+from functools import wraps
+from itertools import chain
+from typing import AsyncIterator, Optional
+import pandas as pd
 import requests
 
-from flask import jsonify, request, render_template, url_for
+from flask import copy_current_request_context, g, jsonify, request, render_template, url_for
 from flask_mail import Message
 import jwt
 from app import app, mail
 from app.logging_utils import track_memory
-from app._topicmod import rank_results
-from app._openai import keywords_from_abstracts
+from app._cache import response_cache
+from app._identifiers import normalize_doi
+from app._openalex_client import openalex_client
+from app._topicmod import NPMI_SOURCES, IncrementalRanker
+from app._executor import (
+    rank_by_lexical_async,
+    rank_by_pagerank_async,
+    rank_results_async,
+    reconstruct_abstracts_async,
+)
+from app._npmi_prior import npmi_prior
+from app._pagerank import CitationGraph
+from app._dedup import WorkDeduper
+from app._stream import STREAM_FORMATS, stream_response
+from app._keywords import KEYWORD_MODES, keyword_queries
 from app._zotero import (
     get_request_token, 
     get_authorization_url, 
@@ -23,83 +45,230 @@ from app._supabase import supabase_test_insert, get_zotero_credentials
 from app._google import append_to_sheet, EMAILS_SPREADSHEET_ID, FEEDBACK_SPREADSHEET_ID
 from app._openalex import (
     multi_search,
+    multi_search_incremental,
+    iter_search_pages,
+    hydrate_papers,
+    paper_fields,
+    ranking_fields,
+    lexical_fields,
     get_papers_from_dois,
-    reconstruct_abstract, 
+    abstract_inputs,
     fetch_all_citation_networks, 
+    fetch_seed_networks,
+    crawl_citers,
     format_authors, 
     format_journal
     )
 
 oauth_token_store = {}
 
+TWO_PHASE_FETCH = str(app.config["TWO_PHASE_FETCH"]).lower() == "true"
+NPMI_SOURCE = app.config["NPMI_SOURCE"]
+QUERIES_RANKINGS = ("npmi", "lexical")
+COLAB_RANKINGS = ("npmi", "pagerank", "lexical")
+INCREMENTAL_RANKING = str(app.config["INCREMENTAL_RANKING"]).lower() == "true"
+NPMI_PRIOR_WEIGHT = float(app.config["NPMI_PRIOR_WEIGHT"])
+STREAM_SNAPSHOT_INTERVAL = float(app.config["STREAM_SNAPSHOT_INTERVAL"])
+STREAM_PREVIEW_SIZE = int(app.config["STREAM_PREVIEW_SIZE"])
+# Body fields that only say whether to use the caches; they are not part of the response cache key
+CACHE_CONTROL_FIELDS = ("queries", "cache", "llm_cache")
+RECOMMENDATION_COLUMNS = ["title", "abstract", "doi", "authorships", "publication_year", "primary_location", "score"]
+
+def collection_fields(two_phase: bool, ranking: str) -> str:
+    """OpenAlex fields to collect candidates with, before ranking"""
+    if not two_phase:
+        return paper_fields
+    return lexical_fields if ranking == "lexical" else ranking_fields
+
+async def rank_candidates(search: pd.DataFrame, ranking: str, top_k: int, exclude_dois: list[str], npmi_source: str,
+                          graph: Optional[CitationGraph] = None, seeds: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """Top-k of the candidates with the requested ranking"""
+    if ranking == "pagerank":
+        return await rank_by_pagerank_async(search, graph, top_k=top_k, exclude_dois=exclude_dois)
+    if ranking == "lexical":
+        return await rank_by_lexical_async(search, seeds, top_k=top_k, exclude_dois=exclude_dois)
+    return await rank_results_async(
+        search, top_k=top_k, exclude_dois=exclude_dois,
+        npmi_source=npmi_source, prior=npmi_prior, prior_weight=NPMI_PRIOR_WEIGHT
+    )
+
+def format_recommendations(recomm: pd.DataFrame) -> list[dict]:
+    """Response schema of the recommendation endpoints; raises KeyError if a column is missing"""
+    recommendations = recomm[RECOMMENDATION_COLUMNS].to_dict("records")
+    formatted_recommendations = []
+    for paper in recommendations:
+        try:
+            formatted_paper = {
+                'title': paper['title'],
+                'abstract': paper['abstract'],
+                'doi': paper['doi'] if isinstance(paper['doi'], str) else None,  # works without a DOI are kept
+                'authors': format_authors(paper['authorships']),
+                'journal': format_journal(paper['primary_location']),
+                'year': paper['publication_year'],
+                'score': paper['score']
+            }
+            formatted_recommendations.append(formatted_paper)
+        except Exception as e:
+            app.logger.error(f"Error formatting paper: {str(e)}")
+            continue
+    return formatted_recommendations
+
+async def present_recommendations(recomm: pd.DataFrame, two_phase: bool) -> list[dict]:
+    """Ranked papers as returned to the client: full metadata, abstracts, formatted"""
+    if recomm.empty:
+        return []
+    if two_phase:
+        recomm = await hydrate_papers(recomm)
+    recomm["abstract"] = await reconstruct_abstracts_async(*abstract_inputs(recomm))
+    return format_recommendations(recomm)
+
+async def recorded(queries: AsyncIterator[str], received: list[str]) -> AsyncIterator[str]:
+    """Pass the queries through, keeping each one in received"""
+    async for query in queries:
+        received.append(query)
+        yield query
+
+def stream_format() -> str:
+    """NDJSON unless the client asks for server-sent events (Accept header or "format" in the body)"""
+    accepts_sse = "text/event-stream" in request.headers.get("Accept", "")
+    return request.json.get("format", "sse" if accepts_sse else "ndjson")
+
+def response_cache_key(endpoint: str, body: dict) -> str:
+    """sha256 of the endpoint, the normalized set of seed DOIs and every other request parameter"""
+    dois = sorted({normalize_doi(doi) or doi for doi in body.get("queries", []) if isinstance(doi, str)})
+    params = {name: value for name, value in body.items() if name not in CACHE_CONTROL_FIELDS}
+    content = json.dumps({"endpoint": endpoint, "dois": dois, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def cached_response(view):
+    """Serve the view's successful JSON responses from response_cache.
+
+    Stale entries are served as they are and refreshed by running the view
+    again on a background thread. "cache": false (or "llm_cache": false) in
+    the body skips the lookup; the fresh response is stored either way,
+    unless its search queries came from the local fallback during an LLM
+    outage (g.keywords_degraded). The X-Cache header says HIT, STALE or MISS.
+    """
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        body = request.get_json(silent=True)
+        if not response_cache.enabled or not isinstance(body, dict):
+            return await view(*args, **kwargs)
+        key = response_cache_key(request.path, body)
+
+        async def respond():
+            response = app.make_response(await view(*args, **kwargs))
+            if response.status_code == 200 and response.is_json:
+                if g.get("keywords_degraded"):
+                    app.logger.info(f"Not caching the response for {request.path}: local fallback keywords")
+                else:
+                    response_cache.put(key, response.get_data(as_text=True))
+            return response
+
+        @copy_current_request_context
+        def revalidate():
+            try:
+                asyncio.run(respond())
+                app.logger.info(f"Refreshed stale response for {request.path}")
+            except Exception as e:
+                app.logger.error(f"Refreshing stale response failed: {str(e)}", exc_info=True)
+            finally:
+                response_cache.finish_refresh(key)
+
+        cached, fresh = (None, False)
+        if body.get("cache", True) and body.get("llm_cache", True):
+            cached, fresh = response_cache.get(key)
+        if cached is None:
+            response = await respond()
+            response.headers["X-Cache"] = "MISS"
+            return response
+        if not fresh and response_cache.start_refresh(key):
+            threading.Thread(target=revalidate, daemon=True).start()
+        app.logger.info(f"Cached response for {request.path}, cache {response_cache.stats()}")
+        return app.response_class(cached, mimetype="application/json", headers={"X-Cache": "HIT" if fresh else "STALE"})
+    return wrapper
+
 @app.route("/")
 def home():
     return render_template("index.html")
 
 
 @app.route("/queries", methods=["POST"])
+@cached_response
 @track_memory
 async def get_recommendations():
     dois = request.json.get("queries", [])
     include_unranked = request.json.get("include_unranked", False)
+    # Collect candidates with a minimal projection and fetch full metadata for the top-k only
+    two_phase = request.json.get("two_phase", TWO_PHASE_FETCH)
+    npmi_source = request.json.get("npmi_source", NPMI_SOURCE)
+    # Rank search pages as they arrive instead of after every query has finished
+    incremental = request.json.get("incremental", INCREMENTAL_RANKING)
+    # "lexical" ranks by BM25 similarity to the input abstracts instead of topic NPMI
+    ranking = request.json.get("ranking", "npmi")
+    # false asks the LLM for new search queries even if this reading list was seen before
+    use_llm_cache = request.json.get("llm_cache", True)
+    # "fast" extracts the search queries locally instead of asking the LLM
+    mode = request.json.get("mode", "llm")
     
     if not dois:
         return jsonify({"error": "No queries provided"}), 400
+    if ranking not in QUERIES_RANKINGS:
+        return jsonify({"error": f"Unknown ranking: {ranking}"}), 400
+    if npmi_source not in NPMI_SOURCES:
+        return jsonify({"error": f"Unknown npmi_source: {npmi_source}, expected one of {', '.join(NPMI_SOURCES)}"}), 400
+    if mode not in KEYWORD_MODES:
+        return jsonify({"error": f"Unknown mode: {mode}"}), 400
     try: 
         papers = await get_papers_from_dois(dois)
         if papers.empty:
             return jsonify({"error": "No valid papers found for the provided DOIs"}), 400
 
-        kwords = keywords_from_abstracts(papers)
-        if not kwords:
-            return jsonify({"error": "Failed to generate keywords from papers"}), 500
-
-        search = await multi_search(kwords, n_results=500, per_page=200)
-        if search.empty:
-            return jsonify({"error": "No search results found"}), 404
-        
-        unranked_dois = search['doi'].tolist() if include_unranked else None
+        # The searches of each query start as soon as the LLM has written it
+        kwords = []
+        queries = recorded(keyword_queries(papers, mode, use_cache=use_llm_cache), kwords)
+
+        if incremental and ranking == "npmi":
+            ranker = IncrementalRanker(
+                top_k=100, exclude_dois=dois,
+                npmi_source=npmi_source, prior=npmi_prior, prior_weight=NPMI_PRIOR_WEIGHT
+            )
+            received = await multi_search_incremental(
+                queries, ranker, n_results=500, per_page=200,
+                fields=collection_fields(two_phase, ranking)
+            )
+            if not kwords:
+                return jsonify({"error": "Failed to generate keywords from papers"}), 500
+            if not received:
+                return jsonify({"error": "No search results found"}), 404
+
+            unranked_dois = list(ranker.seen_dois) if include_unranked else None
+            recomm = ranker.result()
+        else:
+            search = await multi_search(
+                queries, n_results=500, per_page=200,
+                fields=collection_fields(two_phase, ranking)
+            )
+            if not kwords:
+                return jsonify({"error": "Failed to generate keywords from papers"}), 500
+            if search.empty:
+                return jsonify({"error": "No search results found"}), 404
+            
+            unranked_dois = search['doi'].tolist() if include_unranked else None
 
-        recomm = rank_results(search, top_k=100, exclude_dois=dois)
-        
-        app.logger.info("extracting abstract")
-        recomm["abstract"] = recomm["abstract_inverted_index"].apply(reconstruct_abstract)
+            recomm = await rank_candidates(search, ranking, 100, dois, npmi_source, seeds=papers)
         
         try:
-            recommendations = recomm[[
-                "title", 
-                "abstract",
-                "doi", 
-                "authorships",
-                "publication_year", 
-                "primary_location",
-                "score",
-            ]].to_dict("records")
+            formatted_recommendations = await present_recommendations(recomm, two_phase)
         except KeyError as e:
             app.logger.error(f"Missing required column in results: {e}")
             return jsonify({"error": f"Invalid data structure in results: missing {e}"}), 500
 
-        formatted_recommendations = []
-        for paper in recommendations:
-            try:
-                formatted_paper = {
-                    'title': paper['title'],
-                    'abstract': paper['abstract'],
-                    'doi': paper['doi'],
-                    'authors': format_authors(paper['authorships']),
-                    'journal': format_journal(paper['primary_location']),
-                    'year': paper['publication_year'],
-                    'score': paper['score']
-                }
-                formatted_recommendations.append(formatted_paper)
-            except Exception as e:
-                app.logger.error(f"Error formatting paper: {str(e)}")
-                continue
-
         if not formatted_recommendations:
             return jsonify({"error": "Failed to format any recommendations"}), 500
 
         app.logger.info(f"{len(formatted_recommendations)} Recommendations formatted correctly")
+        app.logger.info(f"OpenAlex client {openalex_client.stats()}")
         response_data = {"recommendations": formatted_recommendations}
         if include_unranked:
             response_data["unranked_dois"] = unranked_dois
@@ -111,14 +280,29 @@ async def get_recommendations():
     
 
 @app.route("/v1/colab", methods=["POST"])
+@cached_response
 @track_memory
 async def colab():
     try:
         dois = request.json.get("queries", [])
         if not dois:
             return jsonify({"error": "No queries provided"}), 400
+        two_phase = request.json.get("two_phase", TWO_PHASE_FETCH)
+        npmi_source = request.json.get("npmi_source", NPMI_SOURCE)
+        # "pagerank" ranks by personalized PageRank from the input papers over the crawled citations,
+        # "lexical" by BM25 similarity to their abstracts
+        ranking = request.json.get("ranking", "npmi")
+        if ranking not in COLAB_RANKINGS:
+            return jsonify({"error": f"Unknown ranking: {ranking}"}), 400
+        if npmi_source not in NPMI_SOURCES:
+            return jsonify({"error": f"Unknown npmi_source: {npmi_source}, expected one of {', '.join(NPMI_SOURCES)}"}), 400
+        graph = CitationGraph() if ranking == "pagerank" else None
             
-        search = await fetch_all_citation_networks(dois, total_max_papers=2000)
+        search = await fetch_all_citation_networks(
+            dois, total_max_papers=2000,
+            fields=collection_fields(two_phase, ranking),
+            graph=graph
+        )
         
         if search is None:
             return jsonify({"error": "Citation network fetch returned None"}), 500
@@ -126,39 +310,19 @@ async def colab():
         include_unranked = request.json.get("include_unranked", False)
         unranked_dois = search['doi'].tolist() if include_unranked else None
         
-        # Use existing ranking method
-        recomm = rank_results(search, top_k=100, exclude_dois=dois)
-        recomm["abstract"] = recomm["abstract_inverted_index"].apply(reconstruct_abstract)
+        seeds = await get_papers_from_dois(dois) if ranking == "lexical" else None
+        recomm = await rank_candidates(search, ranking, 100, dois, npmi_source, graph=graph, seeds=seeds)
         
         try:
-            recommendations = recomm[[
-                "title", "abstract", "doi", "authorships",
-                "publication_year", "primary_location", "score",
-            ]].to_dict("records")
+            formatted_recommendations = await present_recommendations(recomm, two_phase)
         except KeyError as e:
             return jsonify({"error": f"Invalid data structure in results: missing {e}"}), 500
 
-        formatted_recommendations = []
-        for paper in recommendations:
-            try:
-                formatted_paper = {
-                    'title': paper['title'],
-                    'abstract': paper['abstract'],
-                    'doi': paper['doi'],
-                    'authors': format_authors(paper['authorships']),
-                    'journal': format_journal(paper['primary_location']),
-                    'year': paper['publication_year'],
-                    'score': paper['score']
-                }
-                formatted_recommendations.append(formatted_paper)
-            except Exception as e:
-                app.logger.error(f"Error formatting paper: {str(e)}")
-                continue
-
         if not formatted_recommendations:
             return jsonify({"error": "Failed to format any recommendations"}), 500
 
         app.logger.info(f"{len(formatted_recommendations)} Recommendations formatted correctly")
+        app.logger.info(f"OpenAlex client {openalex_client.stats()}")
         response_data = {"recommendations": formatted_recommendations}
         if include_unranked:
             response_data["unranked_dois"] = unranked_dois
@@ -174,6 +338,146 @@ async def colab():
         }), 500
 
 
+async def queries_events(dois: list[str], two_phase: bool, npmi_source: str, ranking: str,
+                         include_unranked: bool, use_llm_cache: bool = True, mode: str = "llm") -> AsyncIterator[dict]:
+    """/queries as a stream of events: stages, provisional top-k while search pages arrive, then the result"""
+    try:
+        papers = await get_papers_from_dois(dois)
+        if papers.empty:
+            yield {"event": "error", "error": "No valid papers found for the provided DOIs"}
+            return
+        yield {"event": "stage", "stage": "seeds", "papers": len(papers)}
+
+        yield {"event": "stage", "stage": "search"}
+        kwords = []
+        queries = recorded(keyword_queries(papers, mode, use_cache=use_llm_cache), kwords)
+
+        preview = IncrementalRanker(
+            top_k=STREAM_PREVIEW_SIZE, exclude_dois=dois,
+            npmi_source=npmi_source, prior=npmi_prior, prior_weight=NPMI_PRIOR_WEIGHT
+        ) if ranking == "npmi" else None
+        pages, collected, deduper = {}, [], WorkDeduper()
+        last_snapshot = float("-inf")
+        async for position, page in iter_search_pages(queries, n_results=500, per_page=200,
+                                                      fields=collection_fields(two_phase, ranking)):
+            pages[position] = page
+            page = deduper.filter(page)
+            collected.extend(page)
+            if preview is not None:
+                preview.add(page)
+            if not page or time.monotonic() - last_snapshot < STREAM_SNAPSHOT_INTERVAL:
+                continue
+            if preview is not None:
+                ranked = preview.result()
+            else:
+                ranked = await rank_by_lexical_async(pd.DataFrame(collected), papers, top_k=STREAM_PREVIEW_SIZE, exclude_dois=dois)
+            yield {
+                "event": "provisional",
+                "queries": list(kwords),
+                "candidates": len(collected),
+                "recommendations": await present_recommendations(ranked, two_phase),
+            }
+            last_snapshot = time.monotonic()
+
+        if not kwords:
+            yield {"event": "error", "error": "Failed to generate keywords from papers"}
+            return
+        if not collected:
+            yield {"event": "error", "error": "No search results found"}
+            return
+        # The final ranking sees the candidates in the same order as /queries, ties break the same way
+        search = pd.DataFrame(WorkDeduper().filter(chain.from_iterable(pages[i] for i in sorted(pages))))
+        recomm = await rank_candidates(search, ranking, 100, dois, npmi_source, seeds=papers)
+        result = {
+            "event": "result",
+            "queries": kwords,
+            "recommendations": await present_recommendations(recomm, two_phase),
+        }
+        if include_unranked:
+            result["unranked_dois"] = search["doi"].tolist()
+        app.logger.info(f"OpenAlex client {openalex_client.stats()}")
+        yield result
+    except Exception as e:
+        app.logger.error(f"Error in queries stream: {str(e)}", exc_info=True)
+        yield {"event": "error", "error": str(e)}
+
+
+async def colab_events(dois: list[str], two_phase: bool, npmi_source: str, ranking: str,
+                       include_unranked: bool) -> AsyncIterator[dict]:
+    """/v1/colab as a stream of events: the top-k of the seeds' own networks first, then the crawled result"""
+    try:
+        graph = CitationGraph() if ranking == "pagerank" else None
+        fields = collection_fields(two_phase, ranking)
+        seeds = await get_papers_from_dois(dois) if ranking == "lexical" else None
+        yield {"event": "stage", "stage": "networks", "seeds": len(dois)}
+
+        layer1, proximity, deduper = await fetch_seed_networks(dois, 2000, fields=fields, graph=graph)
+        yield {"event": "stage", "stage": "crawl", "papers": len(layer1)}
+        ranked = await rank_candidates(
+            pd.DataFrame(layer1), ranking, STREAM_PREVIEW_SIZE, dois, npmi_source, graph=graph, seeds=seeds
+        )
+        yield {
+            "event": "provisional",
+            "candidates": len(layer1),
+            "recommendations": await present_recommendations(ranked, two_phase),
+        }
+
+        layer2 = await crawl_citers(layer1, proximity, deduper, 2000, fields=fields, graph=graph)
+        search = pd.DataFrame(layer1 + layer2)
+        recomm = await rank_candidates(search, ranking, 100, dois, npmi_source, graph=graph, seeds=seeds)
+        result = {"event": "result", "recommendations": await present_recommendations(recomm, two_phase)}
+        if include_unranked:
+            result["unranked_dois"] = search["doi"].tolist()
+        app.logger.info(f"OpenAlex client {openalex_client.stats()}")
+        yield result
+    except Exception as e:
+        app.logger.error(f"Error in colab stream: {str(e)}", exc_info=True)
+        yield {"event": "error", "error": str(e)}
+
+
+def stream_request(rankings: tuple) -> tuple:
+    """Request parameters of a streaming endpoint, or an error response"""
+    dois = request.json.get("queries", [])
+    ranking = request.json.get("ranking", "npmi")
+    if not dois:
+        return None, (jsonify({"error": "No queries provided"}), 400)
+    if ranking not in rankings:
+        return None, (jsonify({"error": f"Unknown ranking: {ranking}"}), 400)
+    npmi_source = request.json.get("npmi_source", NPMI_SOURCE)
+    if npmi_source not in NPMI_SOURCES:
+        return None, (jsonify({"error": f"Unknown npmi_source: {npmi_source}, expected one of {', '.join(NPMI_SOURCES)}"}), 400)
+    if stream_format() not in STREAM_FORMATS:
+        return None, (jsonify({"error": f"Unknown stream format: {stream_format()}"}), 400)
+    params = {
+        "dois": dois,
+        "two_phase": request.json.get("two_phase", TWO_PHASE_FETCH),
+        "npmi_source": npmi_source,
+        "ranking": ranking,
+        "include_unranked": request.json.get("include_unranked", False),
+    }
+    return params, None
+
+
+@app.route("/queries/stream", methods=["POST"])
+def get_recommendations_stream():
+    params, error = stream_request(QUERIES_RANKINGS)
+    if error:
+        return error
+    params["use_llm_cache"] = request.json.get("llm_cache", True)
+    params["mode"] = request.json.get("mode", "llm")
+    if params["mode"] not in KEYWORD_MODES:
+        return jsonify({"error": f"Unknown mode: {params['mode']}"}), 400
+    return stream_response(queries_events(**params), stream_format())
+
+
+@app.route("/v1/colab/stream", methods=["POST"])
+def colab_stream():
+    params, error = stream_request(COLAB_RANKINGS)
+    if error:
+        return error
+    return stream_response(colab_events(**params), stream_format())
+
+
 @app.route("/send-results", methods=["POST"])
 def send_results():
     try:
@@ -203,7 +507,7 @@ def send_results():
                     timestamp,
                     recipient_email,
                     len(papers),
-                    ', '.join(p.get('doi', '') for p in papers)
+                    ', '.join(p.get('doi') or '' for p in papers)
                 ]
                 append_to_sheet(EMAILS_SPREADSHEET_ID, row_data)
             except Exception as e:
@@ -1,4 +1,6 @@
+import os
 from app import app
+from app._executor import WARM_POOL, ranking_executor
 from flask_cors import CORS
 
 CORS(app, origins=[
@@ -17,4 +19,7 @@ expose_headers=["Content-Type"],
 
 if __name__ == '__main__':
     port = int(app.config.get('PORT', 5001))  # Use PORT env var, default to 5001 for local dev
+    # In the reloader's child, which serves the requests, not in the process watching the files
+    if WARM_POOL and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        ranking_executor.warm()
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file